@@ -12,10 +12,16 @@
 #include "RooCategoryProxy.h"
 #include "RooAbsReal.h"
 #include "RooAbsCategory.h"
+#include "RVersion.h"
+#if ROOT_VERSION_CODE >= ROOT_VERSION(6,32,0)
+#include "RooFit/EvalContext.h"
+#elif ROOT_VERSION_CODE >= ROOT_VERSION(6,28,0)
+#include "RooFit/Detail/DataMap.h"
+#endif
  
 class DoubleCrystalBallMod : public RooAbsPdf {
 public:
-  DoubleCrystalBallMod() {} ; 
+  DoubleCrystalBallMod() : cacheValid(false) {} ; 
   DoubleCrystalBallMod(const char *name, const char *title,
 	      RooAbsReal& _x,
 	      RooAbsReal& _mean,
@@ -25,7 +31,7 @@ public:
 	      RooAbsReal& _a2,
 	      RooAbsReal& _n2);
   DoubleCrystalBallMod(const DoubleCrystalBallMod& other, const char* name=0) ;
-  virtual TObject* clone(const char* newname) const { return new DoubleCrystalBallMod(*this,newname); }
+  virtual TObject* clone(const char* newname) const override { return new DoubleCrystalBallMod(*this,newname); }
   inline virtual ~DoubleCrystalBallMod() { }
 
 protected:
@@ -38,11 +44,37 @@ protected:
   RooRealProxy a2 ;
   RooRealProxy n2 ;
   
-  Double_t evaluate() const ;
+  Double_t evaluate() const override ;
+
+  // vectorised evaluation for the batch mode of fitTo, compiled out below ROOT 6.28 where only evaluate is used
+#if ROOT_VERSION_CODE >= ROOT_VERSION(6,32,0)
+  void doEval(RooFit::EvalContext &ctx) const override ;
+#elif ROOT_VERSION_CODE >= ROOT_VERSION(6,30,0)
+  void computeBatch(double* output, size_t nEvents, RooFit::Detail::DataMap const& dataMap) const override ;
+#elif ROOT_VERSION_CODE >= ROOT_VERSION(6,28,0)
+  void computeBatch(cudaStream_t*, double* output, size_t nEvents, RooFit::Detail::DataMap const& dataMap) const override ;
+#endif
+
+public:
+
+  Int_t getAnalyticalIntegral(RooArgSet& allVars, RooArgSet& analVars, const char* rangeName=0) const override ;
+  Double_t analyticalIntegral(Int_t code, const char* rangeName=0) const override ;
+
+  // sample x by inverting the piecewise cumulative distribution
+  Int_t getGenerator(const RooArgSet& directVars, RooArgSet &generateVars, Bool_t staticInitOK=kTRUE) const override ;
+  void generateEvent(Int_t code) override ;
 
 private:
 
-  ClassDef(DoubleCrystalBallMod,1) // Your description goes here...
+  // recompute the tail coefficients if a1, n1, a2 or n2 changed since the last call
+  void updateCache() const ;
+
+  // tail coefficients depending only on a1, n1, a2, n2, not streamed
+  mutable Double_t cacheA1, cacheN1, cacheA2, cacheN2 ; //! parameter values of the cached coefficients
+  mutable Double_t A1, A2, B1, B2 ; //!
+  mutable bool cacheValid ;         //!
+
+  ClassDefOverride(DoubleCrystalBallMod,1) // Your description goes here...
 };
  
 #endif
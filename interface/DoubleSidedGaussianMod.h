@@ -13,6 +13,12 @@
 #include "RooAbsReal.h"
 #include "RooAbsCategory.h"
 #include "RooGlobalFunc.h"
+#include "RVersion.h"
+#if ROOT_VERSION_CODE >= ROOT_VERSION(6,32,0)
+#include "RooFit/EvalContext.h"
+#elif ROOT_VERSION_CODE >= ROOT_VERSION(6,28,0)
+#include "RooFit/Detail/DataMap.h"
+#endif
 
 #include "RooArgusBG.h"
 #include "RooRealVar.h"
@@ -26,7 +32,6 @@
 #include "RooConstVar.h"
 #include "RooDataHist.h"
 #include "RooFitResult.h"
-#include "RooMinuit.h"
 #include "RooPlot.h"
  
 class DoubleSidedGaussianMod : public RooAbsPdf {
@@ -39,7 +44,7 @@ public:
 	      RooAbsReal& _sig2,
               Double_t _yMax);
   DoubleSidedGaussianMod(const DoubleSidedGaussianMod& other, const char* name=0) ;
-  virtual TObject* clone(const char* newname) const { return new DoubleSidedGaussianMod(*this,newname); }
+  virtual TObject* clone(const char* newname) const override { return new DoubleSidedGaussianMod(*this,newname); }
   inline virtual ~DoubleSidedGaussianMod() { }
 
 protected:
@@ -48,12 +53,30 @@ protected:
   RooRealProxy mean ;
   RooRealProxy sig1 ;
   RooRealProxy sig2 ;
-  Double_t evaluate() const ;
+  Double_t evaluate() const override ;
+
+  // vectorised evaluation for the batch mode of fitTo, compiled out below ROOT 6.28 where only evaluate is used
+#if ROOT_VERSION_CODE >= ROOT_VERSION(6,32,0)
+  void doEval(RooFit::EvalContext &ctx) const override ;
+#elif ROOT_VERSION_CODE >= ROOT_VERSION(6,30,0)
+  void computeBatch(double* output, size_t nEvents, RooFit::Detail::DataMap const& dataMap) const override ;
+#elif ROOT_VERSION_CODE >= ROOT_VERSION(6,28,0)
+  void computeBatch(cudaStream_t*, double* output, size_t nEvents, RooFit::Detail::DataMap const& dataMap) const override ;
+#endif
+
+public:
+
+  Int_t getAnalyticalIntegral(RooArgSet& allVars, RooArgSet& analVars, const char* rangeName=0) const override ;
+  Double_t analyticalIntegral(Int_t code, const char* rangeName=0) const override ;
+
+  // sample x by inverting the piecewise cumulative distribution
+  Int_t getGenerator(const RooArgSet& directVars, RooArgSet &generateVars, Bool_t staticInitOK=kTRUE) const override ;
+  void generateEvent(Int_t code) override ;
 
 private:
 
   Double_t yMax;
-  ClassDef(DoubleSidedGaussianMod,1) // Your description goes here...
+  ClassDefOverride(DoubleSidedGaussianMod,1) // Your description goes here...
 };
  
 #endif
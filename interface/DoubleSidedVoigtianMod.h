@@ -7,6 +7,12 @@
 #include "RooAbsReal.h"
 #include "RooAbsCategory.h"
 #include "RooGlobalFunc.h"
+#include "RVersion.h"
+#if ROOT_VERSION_CODE >= ROOT_VERSION(6,32,0)
+#include "RooFit/EvalContext.h"
+#elif ROOT_VERSION_CODE >= ROOT_VERSION(6,28,0)
+#include "RooFit/Detail/DataMap.h"
+#endif
 
 #include "RooArgusBG.h"
 #include "RooRealVar.h"
@@ -20,12 +26,23 @@
 #include "RooConstVar.h"
 #include "RooDataHist.h"
 #include "RooFitResult.h"
-#include "RooMinuit.h"
 #include "RooPlot.h"
  
 class DoubleSidedVoigtianMod : public RooAbsPdf {
 public:
-  DoubleSidedVoigtianMod() {} ; 
+  // constants of the shape depending only on sig1, sig2, wid1, wid2, evaluated per event with operator()
+  struct Shape {
+    Double_t C1, C2, A1, A2 ;    // scale and imaginary part of the Faddeeva arguments
+    Double_t scale_factor ;      // ratio of the right to the left side at the mean
+    Double_t total_integral ;
+    Double_t norm1, norm2 ;      // prefactors of the left and right side
+
+    Shape() {}
+    Shape(double sig1, double sig2, double wid1, double wid2) ;
+    double operator()(double x, double mean) const ;
+  };
+
+  DoubleSidedVoigtianMod() : cacheValid(false) {} ; 
   DoubleSidedVoigtianMod(const char *name, const char *title,
 	      RooAbsReal& _x,
 	      RooAbsReal& _mean,
@@ -35,7 +52,7 @@ public:
               RooAbsReal& _wid2,
               Double_t _yMax);
   DoubleSidedVoigtianMod(const DoubleSidedVoigtianMod& other, const char* name=0) ;
-  virtual TObject* clone(const char* newname) const { return new DoubleSidedVoigtianMod(*this,newname); }
+  virtual TObject* clone(const char* newname) const override { return new DoubleSidedVoigtianMod(*this,newname); }
   inline virtual ~DoubleSidedVoigtianMod() { }
 
 protected:
@@ -46,12 +63,30 @@ protected:
   RooRealProxy sig2 ;
   RooRealProxy wid1 ;
   RooRealProxy wid2 ;
-  Double_t evaluate() const ;
+  Double_t evaluate() const override ;
+
+  // vectorised evaluation for the batch mode of fitTo, compiled out below ROOT 6.28 where only evaluate is used
+#if ROOT_VERSION_CODE >= ROOT_VERSION(6,32,0)
+  void doEval(RooFit::EvalContext &ctx) const override ;
+#elif ROOT_VERSION_CODE >= ROOT_VERSION(6,30,0)
+  void computeBatch(double* output, size_t nEvents, RooFit::Detail::DataMap const& dataMap) const override ;
+#elif ROOT_VERSION_CODE >= ROOT_VERSION(6,28,0)
+  void computeBatch(cudaStream_t*, double* output, size_t nEvents, RooFit::Detail::DataMap const& dataMap) const override ;
+#endif
 
 private:
 
+  // recompute the cached shape if the widths changed since the last call
+  void updateCache() const ;
+
   Double_t yMax;
-  ClassDef(DoubleSidedVoigtianMod,1) // Your description goes here...
+
+  // shape for the last sig1, sig2, wid1, wid2, not streamed
+  mutable Double_t cacheSig1, cacheSig2, cacheWid1, cacheWid2 ; //! parameter values of the cached shape
+  mutable Shape cacheShape ; //!
+  mutable bool cacheValid ;  //!
+
+  ClassDefOverride(DoubleSidedVoigtianMod,1) // Your description goes here...
 };
  
 #endif
@@ -0,0 +1,144 @@
+import numpy as np
+
+class DenseTable(object):
+    '''
+    DenseTable
+
+    A dictionary-like container keyed by tuples of labels, for example
+    (process,era,analysis,channel). Each label is assigned an integer id
+    along its axis and floating point values are stored in a NumPy array
+    indexed by those ids. Any other value (histograms, models, integers)
+    is kept in a side table. Unset cells of the array are NaN.
+    Copies share their storage until one of them is modified.
+    '''
+
+    def __init__(self,naxes):
+        self.naxes = naxes
+        self.ids = [{} for n in range(naxes)]     # label -> id, one per axis
+        self.labels = [[] for n in range(naxes)]  # id -> label, one per axis
+        self.values = np.full((1,)*naxes, np.nan)
+        self.objects = {}
+        self.cells = {}     # key -> index tuple, for the labels already assigned ids
+        self.shared = False # storage is shared with a copy
+
+    def copy(self):
+        '''Return a copy that shares the storage until either table is modified.'''
+        result = DenseTable.__new__(DenseTable)
+        result.__dict__.update(self.__dict__)
+        result.cells = {} # ids diverge once either table adds labels
+        self.shared = True
+        result.shared = True
+        return result
+
+    def __own(self):
+        '''Take a private copy of shared storage before modifying it.'''
+        if not self.shared: return
+        self.ids = [dict(ids) for ids in self.ids]
+        self.labels = [list(labels) for labels in self.labels]
+        self.values = self.values.copy()
+        self.objects = dict(self.objects)
+        self.shared = False
+
+    def __isDense(self,value):
+        return isinstance(value,(float,np.floating))
+
+    def __getId(self,axis,label,add=False):
+        if label not in self.ids[axis]:
+            if not add: return -1
+            self.ids[axis][label] = len(self.labels[axis])
+            self.labels[axis] += [label]
+        return self.ids[axis][label]
+
+    def __reserve(self):
+        '''Grow the value array (doubling) so every assigned id fits.'''
+        shape = self.values.shape
+        needed = [len(l) for l in self.labels]
+        if all([n<=s for n,s in zip(needed,shape)]): return
+        newshape = [max(s*2,n) if n>s else s for n,s in zip(needed,shape)]
+        values = np.full(newshape, np.nan)
+        values[tuple([slice(0,s) for s in shape])] = self.values
+        self.values = values
+
+    def __index(self,key,add=False):
+        '''Return the index tuple of a key (None if a label is unknown and add is False).'''
+        index = self.cells.get(key)
+        if index is not None: return index
+        ids = self.ids
+        if not add and not all([k in ids[a] for a,k in enumerate(key)]): return None
+        index = tuple([self.__getId(a,k,add=True) for a,k in enumerate(key)])
+        if add: self.__reserve()
+        self.cells[key] = index
+        return index
+
+    def __setitem__(self,key,value):
+        if self.shared: self.__own()
+        if self.__isDense(value):
+            if self.objects: self.objects.pop(key,None)
+            index = self.__index(key,add=True) # may grow self.values
+            self.values[index] = value
+        else:
+            self.objects[key] = value
+            index = self.__index(key)
+            if index is not None: self.values[index] = np.nan
+
+    def __getitem__(self,key):
+        index = self.__index(key)
+        if index is not None:
+            value = self.values.item(index)
+            if value==value: return value # not NaN
+        return self.objects[key]
+
+    def __contains__(self,key):
+        index = self.__index(key)
+        if index is not None:
+            value = self.values.item(index)
+            if value==value: return True
+        return key in self.objects
+
+    def get(self,key,default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        used = self.values[tuple([slice(0,len(l)) for l in self.labels])]
+        keys = [tuple([self.labels[a][i] for a,i in enumerate(index)]) for index in zip(*np.nonzero(~np.isnan(used)))]
+        return keys + self.objects.keys()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def iteritems(self):
+        for key in self.keys():
+            yield key, self[key]
+
+    def setSlice(self,labels,values):
+        '''
+        Set a block of numeric values at once.
+            labels - one list of labels per axis
+            values - array broadcastable to the shape of the labels
+        '''
+        self.__own()
+        index = [[self.__getId(a,l,add=True) for l in ls] for a,ls in enumerate(labels)]
+        self.__reserve()
+        values = np.broadcast_to(np.asarray(values,dtype=float),tuple([len(i) for i in index]))
+        self.values[np.ix_(*index)] = values
+        for key in self.objects.keys():
+            if all([k in ls for k,ls in zip(key,labels)]): self.objects.pop(key)
+
+    def getSlice(self,labels,default=0.):
+        '''
+        Return a block of numeric values as an array with one dimension per axis.
+        Cells that are unset (or hold a non numeric object) are filled with default.
+        '''
+        index = [[self.__getId(a,l) for l in ls] for a,ls in enumerate(labels)]
+        result = np.full(tuple([len(i) for i in index]), default, dtype=float)
+        found = [[n for n,i in enumerate(ids) if i>=0] for ids in index]
+        if not all(found): return result
+        block = self.values[np.ix_(*[[ids[n] for n in f] for ids,f in zip(index,found)])]
+        result[np.ix_(*found)] = np.where(np.isnan(block), default, block)
+        return result
@@ -2,10 +2,48 @@ import os
 import sys
 import logging
 import numbers
+import multiprocessing
+import hashlib
+import json
+from array import array
+import cPickle as pickle
+from cStringIO import StringIO
 
 import ROOT
+import numpy as np
 
 from DevTools.Limits.Models import Model, ModelSpline
+from DevTools.Limits.DenseTable import DenseTable
+from DevTools.Limits.Profiler import Profiler
+from DevTools.Limits.utilities import getHistHash, getHistBuffers, getHistEdges, buildHist
+
+# the Limits object being printed, inherited by forked card workers
+_cardLimits = None
+
+def _buildCardWorker(args):
+    '''Build a single datacard in a worker process.'''
+    return _cardLimits._buildSingleCard(*args)
+
+class Deferred(object):
+    '''
+    Deferred
+
+    Wraps a callable passed in place of a value to Limits. The callable
+    is only evaluated the first time the value is needed by a card and
+    the result is kept for later calls.
+    '''
+
+    def __init__(self,func):
+        self.func = func
+        self.evaluated = False
+        self.value = None
+
+    def get(self):
+        if not self.evaluated:
+            self.value = self.func()
+            self.evaluated = True
+            self.func = None
+        return self.value
 
 class Limits(object):
     '''
@@ -13,50 +51,174 @@ class Limits(object):
 
     A class to encapsulate an analysis selection and produce 
     a datacard that can be read by the Higgs Combine tool.
+
+    With profile=True the time spent in each phase of printCard (systematic lookup,
+    unwrapping, model building, RooDataHist imports, writing) is recorded in
+    self.profiler, see Profiler.
+
+    With dense=True the expected and observed values are kept in DenseTables:
+    numeric values live in NumPy arrays indexed by integer ids for each
+    process/era/analysis/channel and can be filled and read a slice at a time
+    (see setExpectedSlice). The systematic index is sparse and stays a dict.
     '''
 
-    def __init__(self,name='w'):
+    def __init__(self,name='w',dense=False,profile=False):
+        self.dense = dense
+        self.profiler = Profiler(enabled=profile)
         self.eras = []        # 7, 8, 13 TeV
         self.analyses = []    # analysis name
         self.channels = []    # analysis channel
-        self.observed = {}    # there is one observable per era/analysis/channel combination
+        self.observed = self.__newTable(3) # there is one observable per era/analysis/channel combination
         self.processes = {}   # background and signal processes
         self.groups = {}      # groups of systematics
+        self.autoMCStats = [] # autoMCStats settings, (eras,analyses,channels,settings)
+        self.autoRebinning = [] # automatic rebinning settings, (eras,analyses,channels,settings)
         self.signals = []
         self.backgrounds = []
         self.models = {}      # models to add
-        self.expected = {}    # expected yield, one per process/era/analysis/chanel combination
+        self.expected = self.__newTable(4) # expected yield, one per process/era/analysis/chanel combination
         self.systematics = {} # systematic uncertainties
+        self.systematicIndex = {} # expanded systematic name -> (process,era,analysis,channel) -> value
+        self.sharedIndex = set()  # systematicIndex entries shared with a clone
+        self.unwrapped = {}   # id of 2D histogram -> (2D histogram, unwrapped 1D histogram)
+        self.rebinned = {}    # (id of histogram, bin edges) -> (histogram, rebinned histogram)
+        self.datahists = {}   # shape name -> (content hash, RooDataHist) written with saveWorkspace
         self.name = name
         self.workspace = ROOT.RooWorkspace(self.name)
+        self.workspaceCalls = [] # calls that filled the workspace, replayed by load
 
-    def __wsimport(self, *args) :
+    # ROOT compression algorithm ids
+    compressionAlgorithms = {
+        'zlib': 1,
+        'lzma': 2,
+        'lz4' : 4,
+        'zstd': 5,
+    }
+
+    def __newTable(self,naxes):
+        return DenseTable(naxes) if self.dense else {}
+
+    def __defer(self,value):
+        '''Wrap callables (or tuples/lists of callables) so they are evaluated on first use.'''
+        if isinstance(value,(tuple,list)):
+            return type(value)([self.__defer(v) for v in value])
+        if callable(value) and not isinstance(value,(Deferred,ROOT.TObject,Model)):
+            return Deferred(value)
+        return value
+
+    def __resolve(self,value):
+        '''Evaluate any deferred value.'''
+        if isinstance(value,Deferred):
+            value = value.get()
+        if isinstance(value,(tuple,list)):
+            value = type(value)([v.get() if isinstance(v,Deferred) else v for v in value])
+        return value
+
+    def __wsimport(self, *args, **kwargs) :
         # getattr since import is special in python
         # NB RooWorkspace clones object
+        workspace = kwargs.pop('workspace',self.workspace)
         if len(args) < 2 :
             # Useless RooCmdArg: https://sft.its.cern.ch/jira/browse/ROOT-6785
             args += (ROOT.RooCmdArg(),)
-        return getattr(self.workspace, 'import')(*args)
+        return getattr(workspace, 'import')(*args)
 
     def __unwrap(self,hist):
-        '''Convert 2D histogram to 1D'''
-        nbins = hist.GetNbinsX()*hist.GetNbinsY()
+        '''
+        Convert 2D histogram to 1D.
+        The in-range bins are laid out in global bin order (x fastest),
+        the 1D underflow/overflow take the first/last cell of the 2D histogram.
+        Each 2D histogram is only unwrapped once, later calls return the same 1D histogram,
+        so the result must not be modified (see __labelled).
+        '''
+        key = id(hist)
+        if key in self.unwrapped and self.unwrapped[key][0] is hist: return self.unwrapped[key][1]
+        with self.profiler.phase('unwrap',objects=1):
+            result = self.__unwrapHist(hist)
+        self.unwrapped[key] = (hist,result)
+        return result
+
+    def __unwrapHist(self,hist):
+        nx, ny = hist.GetNbinsX(), hist.GetNbinsY()
+        nbins = nx*ny
+        contents, sumw2 = getHistBuffers(hist)
+        def flatten(cells):
+            cells = cells.reshape(ny+2,nx+2)
+            return np.concatenate(([cells[0,0]],cells[1:-1,1:-1].ravel(),[cells[-1,-1]]))
         result = ROOT.TH1F(hist.GetName(),hist.GetTitle(),nbins,0,nbins)
-        result.SetBinContent(0,hist.GetBinContent(0))
-        result.SetBinError(0,hist.GetBinError(0))
-        result.SetBinContent(nbins+1,hist.GetBinContent(nbins+1))
-        result.SetBinError(nbins+1,hist.GetBinError(nbins+1))
-        for nx in range(hist.GetNbinsX()):
-            for ny in range(hist.GetNbinsY()):
-                b = hist.GetBin(nx+1,ny+1)
-                result.SetBinContent(b,hist.GetBinContent(b))
-                result.SetBinError(b,hist.GetBinError(b))
+        result.Sumw2()
+        result.Set(nbins+2,flatten(contents).astype(np.float32))
+        result.GetSumw2().Set(nbins+2,flatten(sumw2))
+        result.SetEntries(hist.GetEntries())
+        return result
+
+    def __labelled(self,hist,label):
+        '''
+        Return a copy of a histogram named and titled label for the shape file.
+        Histograms may be shared between cards, columns and the unwrap/rebin memos, so they are never renamed.
+        '''
+        result = hist.Clone(label)
+        result.SetTitle(label)
+        return result
+
+    def __buildModel(self,model,label):
+        '''Build a model in the workspace.'''
+        with self.profiler.phase('Model.build',objects=1):
+            model.build(self.workspace,label)
+
+    def __getOutputWorkspace(self,shapes,cards):
+        '''
+        Build the workspace written with saveWorkspace. It only holds the pdfs built
+        for the cards (with everything they depend on, and their _norm if present)
+        and the shapes as RooDataHists, imported in a single pass.
+        RooDataHists are kept between calls and only rebuilt when the content
+        of the histogram under that name changes.
+        '''
+        workspace = ROOT.RooWorkspace(self.name)
+        labels = []
+        for card in cards:
+            labels += [label for label in card['pdfs'] if label not in labels]
+        for label in labels:
+            for name in [label,'{0}_norm'.format(label)]:
+                arg = self.workspace.arg(name)
+                if arg: self.__wsimport(arg,ROOT.RooFit.RecycleConflictNodes(),workspace=workspace)
+        x = ROOT.RooArgList(self.workspace.var('x'))
+        for name in sorted(shapes):
+            hist, histHash = shapes[name]
+            if name not in self.datahists or self.datahists[name][0]!=histHash:
+                with self.profiler.phase('RooDataHist',objects=1):
+                    self.datahists[name] = (histHash,ROOT.RooDataHist(name,name,x,hist))
+            self.__wsimport(self.datahists[name][1],workspace=workspace)
+        return workspace
+
+    def clone(self):
+        '''
+        Return a copy that can be filled independently, e.g. one per mass point
+        from a template holding the common eras, analyses, channels, processes, and systematics.
+        Containers are copied shallowly and the expected, observed, and systematic
+        tables are shared copy-on-write, so a clone only costs what is changed on it.
+        Models and histograms are shared, not copied.
+        Each clone gets its own profiler, so the template's timings only cover the template.
+        '''
+        result = self.__class__.__new__(self.__class__)
+        for key, val in vars(self).iteritems():
+            if isinstance(val,list):
+                val = list(val)
+            elif isinstance(val,(dict,set,DenseTable)):
+                val = val.copy()
+            setattr(result,key,val)
+        result.workspace = ROOT.RooWorkspace(self.workspace)
+        result.profiler = Profiler(enabled=self.profiler.enabled)
+        self.sharedIndex = set(self.systematicIndex)
+        result.sharedIndex = set(self.systematicIndex)
         return result
 
     def addMH(self,mhMin,mhMax):
+        self.workspaceCalls += [('addMH',(mhMin,mhMax),{})]
         self.workspace.factory('MH[{0}, {1}]'.format(mhMin,mhMax))
 
     def addX(self, xMin, xMax, unit='', label=''):
+        self.workspaceCalls += [('addX',(xMin,xMax),{'unit':unit,'label':label})]
         self.workspace.factory('x[{0}, {1}]'.format(xMin,xMax))
         if unit: self.workspace.var('x').setUnit(unit)
         if label: self.workspace.var('x').setPlotLabel(label)
@@ -64,8 +226,9 @@ class Limits(object):
 
     def addModel(self,model,label):
         if label in self.models: return
+        self.workspaceCalls += [('addModel',(model,label),{})]
         self.models[label] = model
-        self.models[label].build(self.workspace,label)
+        self.__buildModel(self.models[label],label)
 
     def __check(self,test,stored,name='Object'):
         goodToAdd = True
@@ -94,6 +257,7 @@ class Limits(object):
             logging.warning('Era {0} already added.'.format(era))
         else:
             self.eras += [era]
+            self.__indexWildcards(1)
 
     def addAnalysis(self,analysis):
         '''Add analysis.'''
@@ -101,6 +265,7 @@ class Limits(object):
             logging.warning('Analysis {0} already added.'.format(analysis))
         else:
             self.analyses += [analysis]
+            self.__indexWildcards(2)
 
     def addChannel(self,channel):
         '''Add channel to analysis.'''
@@ -108,6 +273,7 @@ class Limits(object):
             logging.warning('Channel {0} already added.'.format(channel))
         else:
             self.channels += [channel]
+            self.__indexWildcards(3)
 
     def addProcess(self,proc,signal=False):
         '''
@@ -125,6 +291,7 @@ class Limits(object):
                 self.signals += [proc]
             else:
                 self.backgrounds += [proc]
+            self.__indexWildcards(0)
 
     def addSystematic(self,systname,mode,systematics={}):
         '''
@@ -149,6 +316,8 @@ class Limits(object):
         'value' is either a number for a rate systematic or a TH1 histogram for a shape uncertainty.
         For asymmetric uncertainties, a tuple should be passed with the first the shift up
         and the second the shift down.
+        A value (or either entry of the tuple) can also be a callable taking no arguments,
+        it is evaluated only when a card needs it.
         '''
         if systname in self.systematics:
             logging.warning('Systematic {0} already added.'.format(systname))
@@ -163,34 +332,188 @@ class Limits(object):
             if goodToAdd:
                 self.systematics[systname] = {
                     'mode'  : mode,
-                    'values': systematics,
+                    'values': {key: self.__defer(value) for key,value in systematics.iteritems()},
                 }
+                self.__indexSystematic(systname)
+
+    def __expand(self,test,stored):
+        '''Resolve the 'all' wildcard against the stored components.'''
+        return stored if 'all' in test else test
+
+    def __indexSystematic(self,systname):
+        '''Add a systematic to the lookup index used by getSystematic.'''
+        values = self.systematics[systname]['values']
+        for syst_vals in values:
+            s_processes, s_eras, s_analyses, s_channels = syst_vals
+            for process in self.__expand(s_processes,self.processes.keys()):
+                for era in self.__expand(s_eras,self.eras):
+                    for analysis in self.__expand(s_analyses,self.analyses):
+                        for channel in self.__expand(s_channels,self.channels):
+                            fullSystName = systname.format(process=process,era=era,analysis=analysis,channel=channel)
+                            if fullSystName not in self.systematicIndex:
+                                self.systematicIndex[fullSystName] = {}
+                            elif fullSystName in self.sharedIndex:
+                                self.systematicIndex[fullSystName] = self.systematicIndex[fullSystName].copy()
+                                self.sharedIndex.discard(fullSystName)
+                            self.systematicIndex[fullSystName][(process,era,analysis,channel)] = values[syst_vals]
+
+    def __indexWildcards(self,axis):
+        '''
+        Extend the index after a component was added to an axis (0 process, 1 era, 2 analysis, 3 channel),
+        only systematics using the 'all' wildcard for that axis are affected.
+        '''
+        for systname in self.systematics:
+            if any(['all' in key[axis] for key in self.systematics[systname]['values']]):
+                self.__indexSystematic(systname)
+
+    def __indexSystematics(self):
+        '''Rebuild the systematic lookup index (needed when the 'all' wildcards change meaning).'''
+        self.systematicIndex = {}
+        self.sharedIndex = set()
+        for systname in self.systematics:
+            self.__indexSystematic(systname)
 
     def addGroup(self,groupname,*systnames):
         '''Add a group name for a list of systematics'''
         self.groups[groupname] = systnames
 
+    def addAutoMCStats(self,threshold=0,includeSignal=False,histMode=1,eras=['all'],analyses=['all'],channels=['all']):
+        '''
+        Use the Barlow-Beeston-lite treatment of the template statistical uncertainties
+        for the selected bins, written as '<bin> autoMCStats <threshold> <includeSignal> <histMode>'.
+        This replaces per-process bin-by-bin stat shape systematics.
+        Only written for bins with histogram templates and not when the shapes are saved
+        in a workspace (saveWorkspace), later calls override earlier ones.
+        '''
+        goodToAdd = True
+        goodToAdd = goodToAdd and self.__checkEras(eras)
+        goodToAdd = goodToAdd and self.__checkAnalyses(analyses)
+        goodToAdd = goodToAdd and self.__checkChannels(channels)
+        if goodToAdd:
+            self.autoMCStats += [(eras,analyses,channels,(threshold,int(includeSignal),histMode))]
+
+    def __getBinSettings(self,binSettings,era,analysis,channel):
+        '''Return the last settings in a list of (eras,analyses,channels,settings) matching a bin, or None.'''
+        result = None
+        for eras,analyses,channels,settings in binSettings:
+            if era in self.__expand(eras,self.eras) and analysis in self.__expand(analyses,self.analyses) and channel in self.__expand(channels,self.channels):
+                result = settings
+        return result
+
+    def getAutoMCStats(self,era,analysis,channel):
+        '''Return the autoMCStats settings (threshold,includeSignal,histMode) for a bin or None.'''
+        return self.__getBinSettings(self.autoMCStats,era,analysis,channel)
+
+    def addAutoRebinning(self,minYield=1.,maxRelError=0.5,eras=['all'],analyses=['all'],channels=['all']):
+        '''
+        Rebin the histogram templates of the selected bins when printing cards.
+        The bin edges are chosen from the sum of the background templates: starting
+        from the high edge, bins are merged until the summed background yield is at
+        least minYield and its relative stat uncertainty at most maxRelError.
+        The same edges are used for every process, the shape systematics, and data.
+        2D templates are rebinned after unwrapping.
+        '''
+        goodToAdd = True
+        goodToAdd = goodToAdd and self.__checkEras(eras)
+        goodToAdd = goodToAdd and self.__checkAnalyses(analyses)
+        goodToAdd = goodToAdd and self.__checkChannels(channels)
+        if goodToAdd:
+            self.autoRebinning += [(eras,analyses,channels,(minYield,maxRelError))]
+
+    def getRebinEdges(self,era,analysis,channel,backgrounds=None):
+        '''
+        Return the bin edges for a bin with automatic rebinning, or None.
+        The edges are computed from the given backgrounds, by default all registered backgrounds.
+        '''
+        settings = self.__getBinSettings(self.autoRebinning,era,analysis,channel)
+        if settings is None: return None
+        minYield, maxRelError = settings
+        if backgrounds is None: backgrounds = self.backgrounds
+        hists = [self.getExpected(process,era,analysis,channel) for process in backgrounds]
+        hists = [hist for hist in hists if isinstance(hist,ROOT.TH1)]
+        if not hists: return None
+        # the buffers are only summed if all axes have the same edges, not just the same number of bins
+        referenceEdges = getHistEdges(hists[0])
+        for hist in hists[1:]:
+            histEdges = getHistEdges(hist)
+            if len(histEdges)!=len(referenceEdges) or not all([np.array_equal(a,b) for a,b in zip(histEdges,referenceEdges)]):
+                logging.warning('Backgrounds in {0} {1} {2} have different binning, not rebinning.'.format(era,analysis,channel))
+                return None
+        nbins = hists[0].GetNbinsX()
+        contents = np.zeros(nbins)
+        sumw2 = np.zeros(nbins)
+        for hist in hists:
+            histContents, histSumw2 = getHistBuffers(hist)
+            contents += histContents[1:-1]
+            sumw2 += histSumw2[1:-1]
+        axis = hists[0].GetXaxis()
+        lowEdges = [axis.GetBinLowEdge(b) for b in range(1,nbins+2)]
+        edges = [lowEdges[-1]]
+        total = 0.
+        total2 = 0.
+        for b in reversed(range(nbins)):
+            total += contents[b]
+            total2 += sumw2[b]
+            if total>0 and total>=minYield and total2**0.5<=maxRelError*total:
+                edges += [lowEdges[b]]
+                total = 0.
+                total2 = 0.
+        # merge what is left at the low edge into the last bin
+        if len(edges)>1:
+            edges[-1] = lowEdges[0]
+        else:
+            edges += [lowEdges[0]]
+        return tuple(reversed(edges))
+
+    def __rebin(self,value,edges):
+        '''Rebin a histogram (or a tuple/list of histograms) to the given edges, each histogram only once. The result is shared and must not be modified.'''
+        if edges is None: return value
+        if isinstance(value,(tuple,list)):
+            return type(value)([self.__rebin(v,edges) for v in value])
+        if not isinstance(value,ROOT.TH1): return value
+        key = (id(value),edges)
+        if key in self.rebinned and self.rebinned[key][0] is value: return self.rebinned[key][1]
+        with self.profiler.phase('rebin',objects=1):
+            result = value.Rebin(len(edges)-1,'{0}_rebinned'.format(value.GetName()),array('d',edges))
+        self.rebinned[key] = (value,result)
+        return result
+
     def getSystematic(self,systname,process,era,analysis,channel):
         '''Return the systematic value for a given systematic/process/era/analysis/channel combination.'''
-        # make sure it exists:
+        with self.profiler.phase('getSystematic'):
+            return self.__getSystematic(systname,process,era,analysis,channel)
+
+    def __getSystematic(self,systname,process,era,analysis,channel):
+        key = (process,era,analysis,channel)
+        table = self.systematicIndex.get(systname,{})
+        if key in table:
+            result = table[key]
+        elif process in self.processes and era in self.eras and analysis in self.analyses and channel in self.channels:
+            result = 1.
+        else:
+            # the index only covers registered components, 'all' also matches any other name
+            result = self.__scanSystematic(systname,process,era,analysis,channel)
+        result = self.__resolve(result)
+        if isinstance(result,ROOT.TH2):
+            result = self.__unwrap(result)
+        if isinstance(result,tuple) or isinstance(result,list):
+            if len(result)==2 and isinstance(result[0],ROOT.TH2):
+                result = (self.__unwrap(result[0]),self.__unwrap(result[1]),)
+        return result
+
+    def __scanSystematic(self,systname,process,era,analysis,channel):
+        '''Find a systematic value by matching against all added systematics, the last match is used.'''
         result = 1.
         for syst in self.systematics:
             fullSystName = syst.format(process=process,era=era,analysis=analysis,channel=channel)
             if fullSystName != systname: continue
-            # check if there is a systematic value for this combination
             for syst_vals in self.systematics[syst]['values']:
                 s_processes, s_eras, s_analyses, s_channels = syst_vals
                 if process not in s_processes and 'all' not in s_processes: continue
                 if era not in s_eras and 'all' not in s_eras: continue
                 if analysis not in s_analyses and 'all' not in s_analyses: continue
                 if channel not in s_channels and 'all' not in s_channels: continue
-                # return the value
                 result = self.systematics[syst]['values'][syst_vals]
-        if isinstance(result,ROOT.TH2):
-            result = self.__unwrap(result)
-        if isinstance(result,tuple) or isinstance(result,list):
-            if len(result)==2 and isinstance(result[0],ROOT.TH2):
-                result = (self.__unwrap(result[0]),self.__unwrap(result[1]),)
         return result
 
     def __getSystematicRows(self,syst,processes,era,analysis,channel):
@@ -231,13 +554,35 @@ class Limits(object):
         return combinedSyst
 
     def setObserved(self,era,analysis,channel,value):
-        '''Set the observed value for a given era,analysis,channel.'''
+        '''
+        Set the observed value for a given era,analysis,channel.
+        The value can be a callable taking no arguments, evaluated only when a card needs it.
+        '''
         goodToAdd = True
         goodToAdd = goodToAdd and self.__checkEras([era])
         goodToAdd = goodToAdd and self.__checkAnalyses([analysis])
         goodToAdd = goodToAdd and self.__checkChannels([channel])
         if goodToAdd:
-            self.observed[(era,analysis,channel)] = value
+            self.observed[(era,analysis,channel)] = self.__defer(value)
+
+    def setObservedSlice(self,eras,analyses,channels,values):
+        '''
+        Set the observed values for all era,analysis,channel combinations at once.
+        The values must broadcast to an array of shape (eras,analyses,channels).
+        '''
+        goodToAdd = True
+        goodToAdd = goodToAdd and self.__checkEras(eras)
+        goodToAdd = goodToAdd and self.__checkAnalyses(analyses)
+        goodToAdd = goodToAdd and self.__checkChannels(channels)
+        if not goodToAdd: return
+        if self.dense:
+            self.observed.setSlice([eras,analyses,channels],values)
+        else:
+            values = np.broadcast_to(np.asarray(values,dtype=float),(len(eras),len(analyses),len(channels)))
+            for e,era in enumerate(eras):
+                for a,analysis in enumerate(analyses):
+                    for c,channel in enumerate(channels):
+                        self.observed[(era,analysis,channel)] = float(values[e,a,c])
 
     def getObserved(self,era,analysis,channel,blind=True,addSignal=False):
         '''Get the observed value. If blinded returns the sum of the expected background.'''
@@ -266,75 +611,444 @@ class Limits(object):
                 result = sum(exp)
         else:
             key = (era,analysis,channel)
-            result = self.observed[key] if key in self.observed else 0.
+            result = self.__resolve(self.observed[key]) if key in self.observed else 0.
         if isinstance(result,ROOT.TH2):
             result = self.__unwrap(result)
         return result
 
 
     def setExpected(self,process,era,analysis,channel,value):
-        '''Set the expected value for a given process,era,analysis,channel.'''
+        '''
+        Set the expected value for a given process,era,analysis,channel.
+        The value can be a callable taking no arguments, evaluated only when a card needs it.
+        '''
         goodToAdd = True
         goodToAdd = goodToAdd and self.__checkProcesses([process])
         goodToAdd = goodToAdd and self.__checkEras([era])
         goodToAdd = goodToAdd and self.__checkAnalyses([analysis])
         goodToAdd = goodToAdd and self.__checkChannels([channel])
         if goodToAdd:
-            self.expected[(process,era,analysis,channel)] = value
+            self.expected[(process,era,analysis,channel)] = self.__defer(value)
+
+    def setExpectedSlice(self,processes,eras,analyses,channels,values):
+        '''
+        Set the expected values for all process,era,analysis,channel combinations at once.
+        The values must broadcast to an array of shape (processes,eras,analyses,channels).
+        '''
+        goodToAdd = True
+        goodToAdd = goodToAdd and self.__checkProcesses(processes)
+        goodToAdd = goodToAdd and self.__checkEras(eras)
+        goodToAdd = goodToAdd and self.__checkAnalyses(analyses)
+        goodToAdd = goodToAdd and self.__checkChannels(channels)
+        if not goodToAdd: return
+        if self.dense:
+            self.expected.setSlice([processes,eras,analyses,channels],values)
+        else:
+            values = np.broadcast_to(np.asarray(values,dtype=float),(len(processes),len(eras),len(analyses),len(channels)))
+            for p,process in enumerate(processes):
+                for e,era in enumerate(eras):
+                    for a,analysis in enumerate(analyses):
+                        for c,channel in enumerate(channels):
+                            self.expected[(process,era,analysis,channel)] = float(values[p,e,a,c])
+
+    def getExpectedSlice(self,processes,eras,analyses,channels):
+        '''
+        Get the numeric expected values as an array of shape (processes,eras,analyses,channels).
+        Unset, non numeric, or deferred entries are returned as 0.
+        '''
+        if self.dense:
+            return self.expected.getSlice([processes,eras,analyses,channels])
+        result = np.zeros((len(processes),len(eras),len(analyses),len(channels)))
+        for p,process in enumerate(processes):
+            for e,era in enumerate(eras):
+                for a,analysis in enumerate(analyses):
+                    for c,channel in enumerate(channels):
+                        val = self.expected.get((process,era,analysis,channel),0.)
+                        if isinstance(val,numbers.Number): result[p,e,a,c] = val
+        return result
 
     def getExpected(self,process,era,analysis,channel):
         '''Get the expected value.'''
         key = (process,era,analysis,channel)
-        val = self.expected[key] if key in self.expected else 0.
+        val = self.__resolve(self.expected[key]) if key in self.expected else 0.
         if isinstance(val,ROOT.TH2):
             val = self.__unwrap(val)
         return val if val else 1.0e-10
 
-    def printCard(self,filename,eras=['all'],analyses=['all'],channels=['all'],processes=['all'],blind=True,addSignal=False,saveWorkspace=False,suffix=''):
+    # attributes rebuilt on load rather than saved
+    transientAttributes = ['workspace','systematicIndex','sharedIndex','unwrapped','rebinned','datahists','profiler']
+
+    def __resolveAll(self):
+        '''Evaluate every deferred value.'''
+        for table in [self.expected,self.observed]:
+            for key in table.keys():
+                table[key] = self.__resolve(table[key])
+        for systname in self.systematics:
+            values = self.systematics[systname]['values']
+            for key in values:
+                values[key] = self.__resolve(values[key])
+        self.__indexSystematics()
+
+    def save(self,path):
+        '''
+        Save the full state to a NumPy .npz file at path.
+        Histograms are stored as arrays of bin edges, contents, and sum of squared weights
+        and numeric tables as NumPy arrays, everything else is pickled.
+        Deferred values are evaluated first.
+        The workspace is not saved, it is rebuilt by load from the addMH/addX/addModel calls.
+        '''
+        self.__resolveAll()
+        arrays = {}
+        ids = {}
+        def persistent_id(obj):
+            if isinstance(obj,ROOT.TH1):
+                if id(obj) not in ids:
+                    key = 'hist{0}'.format(len(ids))
+                    ids[id(obj)] = (key,obj)
+                    contents, sumw2 = getHistBuffers(obj)
+                    edges = getHistEdges(obj)
+                    arrays[key+'_contents'] = contents
+                    arrays[key+'_sumw2'] = sumw2
+                    for e,axisEdges in enumerate(edges):
+                        arrays['{0}_edges{1}'.format(key,e)] = axisEdges
+                    return ('hist',key,obj.ClassName(),obj.GetName(),obj.GetTitle(),len(edges),obj.GetEntries())
+                key, obj = ids[id(obj)]
+                return ('hist',key)
+            if isinstance(obj,np.ndarray):
+                if id(obj) not in ids:
+                    key = 'array{0}'.format(len(ids))
+                    ids[id(obj)] = (key,obj)
+                    arrays[key] = obj
+                return ('array',ids[id(obj)][0])
+            return None
+        state = {key: val for key,val in vars(self).iteritems() if key not in self.transientAttributes}
+        buf = StringIO()
+        pickler = pickle.Pickler(buf,pickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = persistent_id
+        pickler.dump(state)
+        arrays['state'] = np.frombuffer(buf.getvalue(),dtype=np.uint8)
+        logging.info('Saving {0}'.format(path))
+        with open(path,'wb') as f:
+            np.savez_compressed(f,**arrays)
+
+    @classmethod
+    def load(cls,path):
+        '''Load a Limits object written by save.'''
+        logging.info('Loading {0}'.format(path))
+        data = np.load(path)
+        objects = {}
+        def persistent_load(pid):
+            kind, key = pid[:2]
+            if key not in objects:
+                if kind=='hist':
+                    histClass, name, title, ndim, entries = pid[2:]
+                    edges = [data['{0}_edges{1}'.format(key,e)] for e in range(ndim)]
+                    objects[key] = buildHist(histClass,name,title,edges,data[key+'_contents'],data[key+'_sumw2'],entries)
+                else:
+                    objects[key] = data[key]
+            return objects[key]
+        unpickler = pickle.Unpickler(StringIO(data['state'].tostring()))
+        unpickler.persistent_load = persistent_load
+        state = unpickler.load()
+        limits = cls.__new__(cls)
+        limits.__dict__.update(state)
+        limits.unwrapped = {}
+        limits.rebinned = {}
+        limits.datahists = {}
+        limits.profiler = Profiler()
+        limits.workspace = ROOT.RooWorkspace(limits.name)
+        # replay the workspace construction
+        calls = limits.workspaceCalls
+        limits.workspaceCalls = []
+        limits.models = {}
+        for method, args, kwargs in calls:
+            getattr(limits,method)(*args,**kwargs)
+        limits.__indexSystematics()
+        return limits
+
+    def printCard(self,filename,eras=['all'],analyses=['all'],channels=['all'],processes=['all'],blind=True,addSignal=False,saveWorkspace=False,suffix='',workers=1,incremental=False,compression=None,prune=None,shapeToLnN=None):
         '''
         Print a datacard to file.
         Select the eras, analyses, channels you want to include.
         Each will correspond to one bin in the datacard.
+        If any of eras, analyses, channels, or processes is a dictionary,
+        one card is printed per entry. With workers>1 these cards are built
+        in a pool of worker processes (not supported with saveWorkspace).
+        With incremental=True a hash of the content of each card and of the
+        shape file is stored in filename.manifest.json and files whose hash
+        is unchanged since the last call are not rewritten.
+        Each shape is written to the shape file once, with compression set by
+        compression=(algorithm,level), e.g. ('lzma',9), if given.
+        With prune set to a threshold (e.g. 0.001) negligible nuisances are dropped:
+        rows with no entries, lnN rows within prune of 1 in every column, and shape
+        rows whose up/down templates agree with the nominal within prune in every bin.
+        The dropped rows are listed in filename.pruned.json.
+        With shapeToLnN set to a chi2/ndf threshold, shape systematics whose up/down
+        templates, normalised to unit area, agree with the nominal below the threshold
+        are written as asymmetric lnN instead. They are listed in filename.shapeToLnN.json.
         '''
 
-        shapes = self._printMultipleCards(filename,eras,analyses,channels,processes,blind,addSignal,saveWorkspace,suffix)
-        
+        with self.profiler.phase('buildCards'):
+            cards = self._buildMultipleCards(filename,eras,analyses,channels,processes,blind,addSignal,saveWorkspace,suffix,workers,prune,shapeToLnN)
+        for card in cards:
+            self.profiler.addCard(card['name'],card['profile'])
+
+        manifestName = filename+'.manifest.json'
+        oldManifest = self.__readManifest(manifestName) if incremental else {}
+        manifest = {'cards': {}, 'shapes': ''}
+        shapes = self.__getUniqueShapes(cards)
+        for card in cards:
+            if incremental:
+                with self.profiler.phase('hash'):
+                    cardHash = self.__getCardHash(card)
+                manifest['cards'][card['name']] = cardHash
+                if oldManifest.get('cards',{}).get(card['name'])==cardHash and os.path.isfile(card['name']+'.txt'):
+                    logging.info('{0}.txt unchanged'.format(card['name']))
+                    continue
+            with self.profiler.phase('writeCard',objects=1):
+                self._writeCard(card)
+
         # shape file
         if shapes:
             outname = filename+'.root'
-            if saveWorkspace:
-                self.workspace.Print()
-                self.workspace.SaveAs(outname)
+            if incremental:
+                with self.profiler.phase('hash'):
+                    manifest['shapes'] = self.__getShapesHash(shapes,cards,saveWorkspace)
+            if incremental and oldManifest.get('shapes')==manifest['shapes'] and os.path.isfile(outname):
+                logging.info('{0} unchanged'.format(outname))
+            elif saveWorkspace:
+                with self.profiler.phase('importWorkspace',objects=len(shapes)):
+                    workspace = self.__getOutputWorkspace(shapes,cards)
+                workspace.Print()
+                with self.profiler.phase('writeShapes',objects=1):
+                    if compression is None:
+                        workspace.SaveAs(outname)
+                    else:
+                        outfile = ROOT.TFile.Open(outname,'RECREATE','',self.__getCompression(compression))
+                        workspace.Write()
+                        outfile.Close()
             else:
-                outfile = ROOT.TFile.Open(outname,'RECREATE')
-                for shape in shapes:
-                    shape.Write('',ROOT.TObject.kOverwrite)
-                outfile.Write()
-                outfile.Close()
+                with self.profiler.phase('writeShapes',objects=len(shapes)):
+                    if compression is None:
+                        outfile = ROOT.TFile.Open(outname,'RECREATE')
+                    else:
+                        outfile = ROOT.TFile.Open(outname,'RECREATE','',self.__getCompression(compression))
+                    for name in sorted(shapes):
+                        shapes[name][0].Write(name)
+                    outfile.Write()
+                    outfile.Close()
 
-    def _printMultipleCards(self,filename,eras,analyses,channels,processes,blind,addSignal,saveWorkspace,suffix):
-        shapes = []
+        if incremental:
+            with open(manifestName,'w') as f:
+                json.dump(manifest,f,indent=2,sort_keys=True)
+
+        if prune is not None:
+            report = {card['name']: card['pruned'] for card in cards}
+            logging.info('Pruned {0} nuisances, see {1}.pruned.json'.format(sum([len(x) for x in report.values()]),filename))
+            with open(filename+'.pruned.json','w') as f:
+                json.dump(report,f,indent=2,sort_keys=True)
+
+        if shapeToLnN is not None:
+            report = {card['name']: card['converted'] for card in cards}
+            logging.info('Converted {0} shape systematics to lnN, see {1}.shapeToLnN.json'.format(sum([len(x) for x in report.values()]),filename))
+            with open(filename+'.shapeToLnN.json','w') as f:
+                json.dump(report,f,indent=2,sort_keys=True)
+
+    def __getUniqueShapes(self,cards):
+        '''
+        Collect the shapes of all cards by the name they are written under.
+        Returns a dictionary name: (histogram, content hash). The same histogram
+        is often referenced by several cards and is only kept once.
+        '''
+        shapes = {}
+        hashes = {}
+        for card in cards:
+            for name, shape in card['shapes']:
+                if name in shapes and shapes[name][0] is shape: continue
+                if id(shape) not in hashes: hashes[id(shape)] = (shape,getHistHash(shape))
+                shapeHash = hashes[id(shape)][1]
+                if name in shapes and shapes[name][1]!=shapeHash:
+                    logging.warning('Shape {0} has different contents in different cards, keeping the last one.'.format(name))
+                shapes[name] = (shape,shapeHash)
+        return shapes
+
+    def __getCompression(self,compression):
+        '''Convert (algorithm, level) to the ROOT compression setting.'''
+        algorithm, level = compression
+        if not isinstance(algorithm,numbers.Number):
+            algorithm = self.compressionAlgorithms[algorithm]
+        return 100*algorithm+level
+
+    def __readManifest(self,manifestName):
+        if not os.path.isfile(manifestName): return {}
+        try:
+            with open(manifestName) as f:
+                return json.load(f)
+        except ValueError:
+            logging.warning('Could not read {0}, regenerating all cards.'.format(manifestName))
+            return {}
+
+    def __getModelSpec(self,label,model):
+        '''String describing the configuration of a model built under label.'''
+        return '{0} {1} {2}'.format(label,model.__class__.__name__,repr(sorted(vars(model).items())))
+
+    def __getCardHash(self,card):
+        '''Hash of the card text (rates, systematic rows) and of the shapes and models it uses.'''
+        result = hashlib.sha1(card['text'])
+        for name, shape in card['shapes']:
+            result.update(name)
+            result.update(getHistHash(shape))
+        for spec in card['models']:
+            result.update(spec)
+        return result.hexdigest()
+
+    def __getShapesHash(self,shapes,cards,saveWorkspace):
+        '''Hash of everything written to the shape file.'''
+        result = hashlib.sha1()
+        for name in sorted(shapes):
+            result.update(name)
+            result.update(shapes[name][1])
+        for card in cards:
+            if saveWorkspace:
+                for spec in card['models']:
+                    result.update(spec)
+        if saveWorkspace:
+            for label in sorted(self.models):
+                result.update(self.__getModelSpec(label,self.models[label]))
+        return result.hexdigest()
+
+    def _getCardJobs(self,eras,analyses,channels,processes,suffix):
+        '''Expand the dictionary arguments of printCard into the list of single cards to print.'''
+        jobs = []
         if isinstance(eras,dict):
             for k,v in eras.iteritems():
-                shapes += self._printMultipleCards(filename,v,analyses,channels,processes,blind,addSignal,saveWorkspace,'{0}_{1}'.format(suffix,k))
+                jobs += self._getCardJobs(v,analyses,channels,processes,'{0}_{1}'.format(suffix,k))
         elif isinstance(analyses,dict):
             for k,v in analyses.iteritems():
-                shapes += self._printMultipleCards(filename,eras,v,channels,processes,blind,addSignal,saveWorkspace,'{0}_{1}'.format(suffix,k))
+                jobs += self._getCardJobs(eras,v,channels,processes,'{0}_{1}'.format(suffix,k))
         elif isinstance(channels,dict):
             for k,v in channels.iteritems():
-                shapes += self._printMultipleCards(filename,eras,analyses,v,processes,blind,addSignal,saveWorkspace,'{0}_{1}'.format(suffix,k))
+                jobs += self._getCardJobs(eras,analyses,v,processes,'{0}_{1}'.format(suffix,k))
         elif isinstance(processes,dict):
             for k,v in processes.iteritems():
-                shapes += self._printMultipleCards(filename,eras,analyses,channels,v,blind,addSignal,saveWorkspace,'{0}_{1}'.format(suffix,k))
+                jobs += self._getCardJobs(eras,analyses,channels,v,'{0}_{1}'.format(suffix,k))
         else:
-            shapes += self._printSingleCard(filename,eras,analyses,channels,processes,blind,addSignal,saveWorkspace,suffix)
-            
-        return shapes
+            jobs += [(eras,analyses,channels,processes,suffix)]
+        return jobs
+
+    def _buildMultipleCards(self,filename,eras,analyses,channels,processes,blind,addSignal,saveWorkspace,suffix,workers=1,prune=None,shapeToLnN=None):
+        global _cardLimits
+        jobs = [(filename,e,a,c,p,blind,addSignal,saveWorkspace,s,prune,shapeToLnN) for e,a,c,p,s in self._getCardJobs(eras,analyses,channels,processes,suffix)]
+        if workers>1 and saveWorkspace:
+            logging.warning('Cannot build cards in parallel when saving the workspace, using a single process.')
+            workers = 1
+        workers = min(workers,len(jobs))
+        if workers>1:
+            # workers are forked, so they see the current state of this object
+            _cardLimits = self
+            pool = multiprocessing.Pool(workers)
+            try:
+                cards = pool.map(_buildCardWorker,jobs)
+            finally:
+                pool.close()
+                pool.join()
+                _cardLimits = None
+        else:
+            cards = [self._buildSingleCard(*job) for job in jobs]
+        return [card for card in cards if card is not None]
 
+    def _writeCard(self,card):
+        logging.info('Writing {0}.txt'.format(card['name']))
+        with open(card['name']+'.txt','w') as f:
+            f.write(card['text'])
 
+    def __isNegligible(self,value,nominal,prune):
+        '''Check if a single systematic entry has an effect below the prune threshold.'''
+        if isinstance(value,numbers.Number):
+            return abs(value-1)<prune
+        if isinstance(value,ROOT.TH1):
+            if not isinstance(nominal,ROOT.TH1): return False
+            shift = getHistBuffers(value)[0]
+            nom = getHistBuffers(nominal)[0]
+            if shift.shape!=nom.shape: return False
+            return bool(np.all(np.abs(shift-nom)<=prune*np.abs(nom)))
+        if isinstance(value,(tuple,list)) and len(value)==2:
+            return self.__isNegligible(value[0],nominal,prune) and self.__isNegligible(value[1],nominal,prune)
+        return False
+
+    def __getPruneReason(self,mode,values,nominals,prune):
+        '''
+        Return why a systematic row can be pruned, or an empty string to keep it.
+        values and nominals are dictionaries keyed by (era,analysis,channel,process).
+        '''
+        if all([values[key]==1 for key in values]):
+            return 'no entries'
+        if mode=='lnN' or mode.startswith('shape'):
+            if all([self.__isNegligible(values[key],nominals.get(key),prune) for key in values]):
+                return 'below threshold {0}'.format(prune)
+        return ''
+
+    def __getShapeChi2(self,shift,nominal):
+        '''
+        Return the chi2/ndf between the unit normalised shifted and nominal templates,
+        or None if they cannot be compared.
+        '''
+        shiftVals, shiftErrs2 = [x[1:-1] for x in getHistBuffers(shift)]
+        nomVals, nomErrs2 = [x[1:-1] for x in getHistBuffers(nominal)]
+        if shiftVals.shape!=nomVals.shape: return None
+        shiftInt, nomInt = shiftVals.sum(), nomVals.sum()
+        if shiftInt<=0 or nomInt<=0: return None
+        variance = shiftErrs2/shiftInt**2 + nomErrs2/nomInt**2
+        used = variance>0
+        if not used.any(): return None
+        chi2 = ((shiftVals[used]/shiftInt-nomVals[used]/nomInt)**2/variance[used]).sum()
+        return chi2/max(used.sum()-1,1)
+
+    def __getShapeAsLnN(self,values,nominals,threshold):
+        '''
+        Test if every up/down template pair of a shape systematic only changes the normalisation,
+        i.e. the chi2/ndf of the normalised templates is below threshold.
+        Returns the lnN values keyed by (era,analysis,channel,process) and the largest chi2/ndf,
+        or (None, None) if the row has to stay a shape.
+        '''
+        lnNValues = {}
+        maxChi2 = 0.
+        for key in values:
+            value = values[key]
+            if value==1:
+                lnNValues[key] = 1
+                continue
+            nominal = nominals.get(key)
+            if not isinstance(nominal,ROOT.TH1): return None, None
+            if not (isinstance(value,(tuple,list)) and len(value)==2 and isinstance(value[0],ROOT.TH1)): return None, None
+            for shift in value:
+                chi2 = self.__getShapeChi2(shift,nominal)
+                if chi2 is None or chi2>=threshold: return None, None
+                maxChi2 = max(maxChi2,chi2)
+            nomInt = nominal.Integral()
+            # combine expects asymmetric lnN as kappaDown/kappaUp
+            lnNValues[key] = (value[1].Integral()/nomInt, value[0].Integral()/nomInt)
+        return lnNValues, maxChi2
 
+    def _buildSingleCard(self,filename,eras,analyses,channels,processes,blind,addSignal,saveWorkspace,suffix,prune=None,shapeToLnN=None):
+        '''
+        Build the text of a single datacard.
+        Returns a dictionary with the card name, its text, the (name, histogram)
+        pairs of the shapes it references, the specs and workspace labels of the models it builds,
+        the systematics dropped by pruning with the reason, the shape
+        systematics converted to lnN with their chi2/ndf, and the profiler
+        phases recorded while building it.
+        '''
+        self.profiler.startCard()
+        try:
+            with self.profiler.phase('buildCard',objects=1):
+                card = self.__buildSingleCard(filename,eras,analyses,channels,processes,blind,addSignal,saveWorkspace,suffix,prune,shapeToLnN)
+        finally:
+            profile = self.profiler.endCard()
+        if card is not None: card['profile'] = profile
+        return card
 
-    def _printSingleCard(self,filename,eras,analyses,channels,processes,blind,addSignal,saveWorkspace,suffix):
+    def __buildSingleCard(self,filename,eras,analyses,channels,processes,blind,addSignal,saveWorkspace,suffix,prune,shapeToLnN):
         goodToPrint = True
         goodToPrint = goodToPrint and self.__checkEras(eras)
         goodToPrint = goodToPrint and self.__checkAnalyses(analyses)
@@ -348,6 +1062,12 @@ class Limits(object):
         signals = [x for x in self.signals if x in processes]
         backgrounds = [x for x in self.backgrounds if x in processes]
         shapes = []
+        models = []
+        pdfs = []
+        nominals = {}
+        pruned = {}
+        converted = {}
+        rebinEdges = {}
 
         # setup bins
         bins = ['bin']
@@ -358,16 +1078,15 @@ class Limits(object):
                 for channel in channels:
                     blabel = binName.format(era=era,analysis=analysis,channel=channel)
                     bins += [blabel]
+                    rebinEdges[(era,analysis,channel)] = self.getRebinEdges(era,analysis,channel,backgrounds=backgrounds)
                     obs = self.getObserved(era,analysis,channel,blind=blind,addSignal=addSignal)
+                    obs = self.__rebin(obs,rebinEdges[(era,analysis,channel)])
                     label = 'data_obs_{0}'.format(blabel)
                     if isinstance(obs,ROOT.TH1):
                         logging.debug('{0}: {1}'.format(label,obs.Integral()))
-                        obs.SetName(label)
-                        obs.SetTitle(label)
-                        shapes += [obs]
+                        obs = self.__labelled(obs,label)
+                        shapes += [(label,obs)]
                         if saveWorkspace:
-                            datahist = ROOT.RooDataHist(label, label, ROOT.RooArgList(self.workspace.var("x")), obs)
-                            self.__wsimport(datahist)
                             obs = -1
                         else:
                             obs = obs.Integral()
@@ -397,20 +1116,21 @@ class Limits(object):
                         processNames[colpos] = process
                         processNumbers[colpos] = '{0:<10}'.format(processesOrdered.index(process)-len(signals)+1)
                         exp = self.getExpected(process,era,analysis,channel)
+                        exp = self.__rebin(exp,rebinEdges[(era,analysis,channel)])
                         label = '{0}_{1}'.format(processNames[colpos],binsForRates[colpos])
                         if isinstance(exp,ROOT.TH1):
                             logging.debug('{0}: {1}'.format(label,exp.Integral()))
-                            exp.SetName(label)
-                            exp.SetTitle(label)
-                            shapes += [exp]
+                            exp = self.__labelled(exp,label)
+                            nominals[(era,analysis,channel,process)] = exp
+                            shapes += [(label,exp)]
                             if saveWorkspace:
-                                datahist = ROOT.RooDataHist(label, label, ROOT.RooArgList(self.workspace.var("x")), exp)
-                                self.__wsimport(datahist)
                                 exp = -1
                             else:
                                 exp = exp.Integral()
                         elif isinstance(exp,Model):
-                            exp.build(self.workspace,label)
+                            self.__buildModel(exp,label)
+                            models += [self.__getModelSpec(label,exp)]
+                            pdfs += [label]
                             if isinstance(exp,ModelSpline):
                                 exp = exp.getIntegral(self.workspace)
                             else:
@@ -448,50 +1168,58 @@ class Limits(object):
                 # TODO: implement param uncertainties
                 pass
             else:
-                thisRow = [syst,combinedSysts[syst]['mode']]
+                mode = combinedSysts[syst]['mode']
+                values = {}
+                for key in combinedSysts[syst]['systs']:
+                    if key[3] in processesOrdered: values[key] = self.__rebin(combinedSysts[syst]['systs'][key],rebinEdges[key[:3]])
+                if prune is not None:
+                    reason = self.__getPruneReason(mode,values,nominals,prune)
+                    if reason:
+                        logging.debug('Pruning {0}: {1}'.format(syst,reason))
+                        pruned[syst] = reason
+                        continue
+                if shapeToLnN is not None and mode=='shape':
+                    lnNValues, chi2 = self.__getShapeAsLnN(values,nominals,shapeToLnN)
+                    if lnNValues is not None:
+                        logging.debug('Converting {0} to lnN: chi2/ndf {1}'.format(syst,chi2))
+                        converted[syst] = float(chi2)
+                        mode = 'lnN'
+                        values = lnNValues
+                thisRow = [syst,mode]
                 for era in eras:
                     for analysis in analyses:
                         for channel in channels:
                             for process in processesOrdered:
                                 key = (era,analysis,channel,process)
                                 s = '-'
-                                if key in combinedSysts[syst]['systs']:
-                                    s = combinedSysts[syst]['systs'][key]
+                                if key in values:
+                                    s = values[key]
                                     if s==1:
                                         s = '-'
                                     elif isinstance(s,ROOT.TH1):
                                         label = '{0}_{1}_{2}'.format(process,binName.format(era=era,analysis=analysis,channel=channel),syst)
-                                        s.SetName(label)
-                                        s.SetTitle(label)
-                                        shapes += [s]
-                                        if saveWorkspace:
-                                            datahist = ROOT.RooDataHist(label, label, ROOT.RooArgList(self.workspace.var("x")), s)
-                                            self.__wsimport(datahist)
+                                        s = self.__labelled(s,label)
+                                        shapes += [(label,s)]
                                         s = '1'
                                     elif isinstance(s,Model):
                                         label = '{0}_{1}_{2}'.format(process,binName.format(era=era,analysis=analysis,channel=channel),syst)
-                                        s.build(self.workspace,label)
+                                        self.__buildModel(s,label)
+                                        models += [self.__getModelSpec(label,s)]
+                                        pdfs += [label]
                                         s = '1'
                                     elif (isinstance(s,tuple) or isinstance(s,list)) and len(s)==2:
                                         if isinstance(s[0],ROOT.TH1):
                                             label_up = '{0}_{1}_{2}Up'.format(process,binName.format(era=era,analysis=analysis,channel=channel),syst)
                                             label_down = '{0}_{1}_{2}Down'.format(process,binName.format(era=era,analysis=analysis,channel=channel),syst)
-                                            s[0].SetName(label_up)
-                                            s[0].SetTitle(label_up)
-                                            s[1].SetName(label_down)
-                                            s[1].SetTitle(label_down)
-                                            shapes += s
-                                            if saveWorkspace:
-                                                datahist_up = ROOT.RooDataHist(label_up, label_up, ROOT.RooArgList(self.workspace.var("x")), s[0])
-                                                datahist_down = ROOT.RooDataHist(label_down, label_down, ROOT.RooArgList(self.workspace.var("x")), s[1])
-                                                self.__wsimport(datahist_up)
-                                                self.__wsimport(datahist_down)
+                                            shapes += [(label_up,self.__labelled(s[0],label_up)),(label_down,self.__labelled(s[1],label_down))]
                                             s = '1'
                                         elif isinstance(s[0],Model):
                                             label_up = '{0}_{1}_{2}Up'.format(process,binName.format(era=era,analysis=analysis,channel=channel),syst)
                                             label_down = '{0}_{1}_{2}Down'.format(process,binName.format(era=era,analysis=analysis,channel=channel),syst)
-                                            s[0].build(self.workspace,label_up)
-                                            s[1].build(self.workspace,label_down)
+                                            self.__buildModel(s[0],label_up)
+                                            self.__buildModel(s[1],label_down)
+                                            models += [self.__getModelSpec(label_up,s[0]),self.__getModelSpec(label_down,s[1])]
+                                            pdfs += [label_up,label_down]
                                             s = '1'
                                         elif isinstance(s[0],numbers.Number):
                                             s = '{0:>4.4g}/{1:<4.4g}'.format(*s)
@@ -499,7 +1227,7 @@ class Limits(object):
                                             logging.error('Do not know how to handle {0}'.format(s))
                                             raise
                                     elif isinstance(s,numbers.Number):
-                                        if s<1 and combinedSysts[syst]['mode']=='lnN':
+                                        if s<1 and mode=='lnN':
                                             logging.error('Systematic less than 1: {} {} {} {} {} {}'.format(syst,era,analysis,channel,process,s))
                                             s = 1
                                         elif s<0:
@@ -511,74 +1239,98 @@ class Limits(object):
 
         kmax = len(systRows)
 
-        # now write to file
-        logging.info('Writing {0}{1}.txt'.format(filename,suffix))
-        with open(filename+suffix+'.txt','w') as f:
-            lineWidth = 80
-            firstWidth = 40
-            restWidth = 30
-            def getline(row):
-                try:
-                    return '{0} {1}\n'.format(row[0][:firstWidth]+' '*max(0,firstWidth-len(row[0])), ''.join([r[:restWidth]+' '*max(0,restWidth-len(r)) for r in row[1:]]))
-                except:
-                    print row
-                    e = sys.exc_info()[0]
-                    print e
-                    raise
-
-            def getparamline(row):
-                try:
-                    return ' '.join([str(x) for x in row])+'\n'
-                except:
-                    print row
-                    e = sys.exc_info()[0]
-                    print e
-                    raise
-
-            # header
-            f.write('imax {0} number of bins\n'.format(imax))
-            #f.write('jmax {0} number of processes\n'.format(jmax))
-            f.write('jmax * number of processes\n')
-            f.write('kmax * number of nuissances\n')
-            f.write('-'*lineWidth+'\n')
-
-            # shape information
-            if shapes:
-                for b in bins[1:]:
-                    procString = '$PROCESS_{0}'.format(b)
-                    if saveWorkspace: procString = '{0}:{1}'.format(self.name,procString)
-                    f.write('shapes * {0} {1}.root {2} {2}_$SYSTEMATIC\n'.format(b,filename,procString))
-            else:
-                f.write('shapes * * FAKE\n')
-            f.write('-'*lineWidth+'\n')
-            
-            # observation
-            f.write(getline(bins))
-            f.write(getline(observations))
-            f.write('-'*lineWidth+'\n')
-
-            # process definition
-            logging.debug('Bins: {0}'.format([str(x) for x in binsForRates]))
-            f.write(getline(binsForRates))
-            f.write(getline(processNames))
-            f.write(getline(processNumbers))
-            logging.debug('Rates: {0}'.format([str(x) for x in rates]))
-            f.write(getline(rates))
-            f.write('-'*lineWidth+'\n')
-
-            # nuissances
-            for systRow in systRows:
-                logging.debug('Systematic row: {0}'.format([str(x) for x in systRow]))
-                f.write(getline(systRow))
-            f.write('-'*lineWidth+'\n')
-
-            # rateParams
-            for norm in norms:
-                logging.debug('Rate param: {0}'.format([str(x) for x in norm]))
-                f.write(getparamline(norm))
-
-            # nuissance categories
-            for group in self.groups:
-                f.write('{0} group = {1}'.format(group,' '.join(self.groups[group])))
+        # now build the card text
+        lines = []
+        lineWidth = 80
+        firstWidth = 40
+        restWidth = 30
+        def getline(row):
+            try:
+                return '{0} {1}\n'.format(row[0][:firstWidth]+' '*max(0,firstWidth-len(row[0])), ''.join([r[:restWidth]+' '*max(0,restWidth-len(r)) for r in row[1:]]))
+            except:
+                print row
+                e = sys.exc_info()[0]
+                print e
+                raise
 
-        return shapes
+        def getparamline(row):
+            try:
+                return ' '.join([str(x) for x in row])+'\n'
+            except:
+                print row
+                e = sys.exc_info()[0]
+                print e
+                raise
+
+        # header
+        lines.append('imax {0} number of bins\n'.format(imax))
+        #lines.append('jmax {0} number of processes\n'.format(jmax))
+        lines.append('jmax * number of processes\n')
+        lines.append('kmax * number of nuissances\n')
+        lines.append('-'*lineWidth+'\n')
+
+        # shape information
+        if shapes:
+            for b in bins[1:]:
+                procString = '$PROCESS_{0}'.format(b)
+                if saveWorkspace: procString = '{0}:{1}'.format(self.name,procString)
+                lines.append('shapes * {0} {1}.root {2} {2}_$SYSTEMATIC\n'.format(b,filename,procString))
+        else:
+            lines.append('shapes * * FAKE\n')
+        lines.append('-'*lineWidth+'\n')
+        
+        # observation
+        lines.append(getline(bins))
+        lines.append(getline(observations))
+        lines.append('-'*lineWidth+'\n')
+
+        # process definition
+        logging.debug('Bins: {0}'.format([str(x) for x in binsForRates]))
+        lines.append(getline(binsForRates))
+        lines.append(getline(processNames))
+        lines.append(getline(processNumbers))
+        logging.debug('Rates: {0}'.format([str(x) for x in rates]))
+        lines.append(getline(rates))
+        lines.append('-'*lineWidth+'\n')
+
+        # nuissances
+        for systRow in systRows:
+            logging.debug('Systematic row: {0}'.format([str(x) for x in systRow]))
+            lines.append(getline(systRow))
+        lines.append('-'*lineWidth+'\n')
+
+        # rateParams
+        for norm in norms:
+            logging.debug('Rate param: {0}'.format([str(x) for x in norm]))
+            lines.append(getparamline(norm))
+
+        # bin-by-bin template statistics, only for bins with histogram templates
+        templateBins = set([key[:3] for key in nominals])
+        skipped = []
+        for era in eras:
+            for analysis in analyses:
+                for channel in channels:
+                    settings = self.getAutoMCStats(era,analysis,channel)
+                    if settings is None or (era,analysis,channel) not in templateBins: continue
+                    if saveWorkspace:
+                        skipped += [binName.format(era=era,analysis=analysis,channel=channel)]
+                        continue
+                    lines.append(getparamline([binName.format(era=era,analysis=analysis,channel=channel),'autoMCStats']+list(settings)))
+        if skipped:
+            logging.warning('autoMCStats only applies to histogram templates, not to workspace shapes, not added for: {0}'.format(' '.join(skipped)))
+
+        # nuissance categories
+        for group in self.groups:
+            groupSysts = [x for x in self.groups[group] if x not in pruned]
+            if not groupSysts: continue
+            lines.append('{0} group = {1}'.format(group,' '.join(groupSysts)))
+
+        return {
+            'name'  : filename+suffix,
+            'text'  : ''.join(lines),
+            'shapes': shapes,
+            'models': models,
+            'pdfs'  : pdfs,
+            'pruned': pruned,
+            'converted': converted,
+        }
@@ -1,9 +1,255 @@
+import os
 import logging
+import hashlib
+import json
+import time
+import atexit
+import tempfile
+import multiprocessing
 
 from array import array
 
 import ROOT
 
+from DevTools.Limits.utilities import getDataHash
+
+class FitResult(dict):
+    '''
+    The fitted parameter values keyed by name.
+    The errors and the minimiser summary (status, covQual, edm, minNll),
+    the fit wall time in seconds and the fitOptions used are attributes.
+    cached is set when the result was read from the fit cache rather than fitted.
+    '''
+
+    def __init__(self,values={},errors={},status=0,cached=False,covQual=-1,edm=0.,minNll=0.,time=0.,options={}):
+        super(FitResult,self).__init__(values)
+        self.errors = dict(errors)
+        self.status = status
+        self.cached = cached
+        self.covQual = covQual
+        self.edm = edm
+        self.minNll = minNll
+        self.time = time
+        self.options = dict(options)
+
+    def summary(self):
+        '''The minimiser summary as a dict.'''
+        return {
+            'status' : self.status,
+            'covQual': self.covQual,
+            'edm'    : self.edm,
+            'minNll' : self.minNll,
+            'time'   : self.time,
+            'options': self.options,
+        }
+
+def readFitCache(cache,key):
+    '''Return the FitResult stored under key in the cache directory, or None.'''
+    cachename = os.path.join(cache,'{0}.json'.format(key))
+    if not os.path.isfile(cachename): return None
+    try:
+        with open(cachename) as f:
+            stored = json.load(f)
+    except ValueError:
+        logging.warning('Could not read fit cache {0}, refitting.'.format(cachename))
+        return None
+    values = {str(key): val for key,val in stored['values'].iteritems()}
+    errors = {str(key): val for key,val in stored['errors'].iteritems()}
+    summary = dict([(str(key),val) for key,val in stored.iteritems() if key not in ['values','errors']])
+    return FitResult(values,errors,cached=True,**summary)
+
+def writeFitCache(cache,key,result):
+    '''Store a FitResult under key in the cache directory.'''
+    if not os.path.isdir(cache): os.makedirs(cache)
+    cachename = os.path.join(cache,'{0}.json'.format(key))
+    # write then rename so concurrent readers never see a partial file
+    tmpname = '{0}.{1}.tmp'.format(cachename,os.getpid())
+    with open(tmpname,'w') as f:
+        stored = result.summary()
+        stored.update({'values': dict(result), 'errors': result.errors})
+        json.dump(stored,f,indent=2,sort_keys=True)
+    os.rename(tmpname,cachename)
+
+def getFitArgs(fitOptions):
+    '''
+    RooFit command arguments for fitTo from a dict of likelihood options:
+        numCPU   - number of processes evaluating the likelihood
+        batch    - vectorised evaluation (EvalBackend('cpu') or BatchMode, depending on the ROOT version)
+        offset   - offset the likelihood for numerical stability
+        optimize - constant term optimisation level
+        strategy - Minuit strategy
+    '''
+    args = [ROOT.RooFit.Save(), ROOT.RooFit.SumW2Error(True)]
+    for option,value in sorted((fitOptions or {}).iteritems()):
+        if option=='numCPU':
+            args += [ROOT.RooFit.NumCPU(int(value))]
+        elif option=='batch':
+            if not value: continue
+            if hasattr(ROOT.RooFit,'EvalBackend'):
+                args += [ROOT.RooFit.EvalBackend('cpu')]
+            elif hasattr(ROOT.RooFit,'BatchMode'):
+                args += [ROOT.RooFit.BatchMode(True)]
+            else:
+                logging.warning('Batch evaluation is not available in this ROOT version')
+        elif option=='offset':
+            args += [ROOT.RooFit.Offset(bool(value))]
+        elif option=='optimize':
+            args += [ROOT.RooFit.Optimize(int(value))]
+        elif option=='strategy':
+            args += [ROOT.RooFit.Strategy(int(value))]
+        else:
+            logging.warning('Unknown fit option {0}'.format(option))
+    return args
+
+plotModes = ['inline','async','skip']
+_plotMode = 'inline'
+_plotQueue = None
+_plotProcess = None
+_plotOwner = None
+
+def setPlotMode(mode):
+    '''
+    Choose how the diagnostic plots of fits with save=True are drawn:
+        inline - before the fit returns
+        async  - the workspace and data are written to a temporary file
+                 and drawn by a background process
+        skip   - not drawn
+    Set async before starting any process pool so that the pool workers share the render queue.
+    '''
+    global _plotMode
+    if mode not in plotModes:
+        logging.error('Unknown plot mode {0}, use one of {1}'.format(mode,', '.join(plotModes)))
+        return
+    _plotMode = mode
+    if mode=='async': startPlotter()
+
+def startPlotter():
+    '''Start the background process drawing queued plots.'''
+    global _plotQueue, _plotProcess, _plotOwner
+    if _plotProcess is not None: return
+    _plotQueue = multiprocessing.Queue()
+    _plotProcess = multiprocessing.Process(target=renderPlots,args=(_plotQueue,))
+    _plotProcess.start()
+    _plotOwner = os.getpid()
+    atexit.register(flushPlots)
+
+def flushPlots():
+    '''Wait for the queued plots to be drawn and stop the background process.'''
+    global _plotQueue, _plotProcess
+    if _plotProcess is None or os.getpid()!=_plotOwner: return
+    _plotQueue.put(None)
+    _plotProcess.join()
+    _plotQueue = None
+    _plotProcess = None
+
+def renderPlots(queue):
+    '''Draw plot requests from the queue until None is received.'''
+    ROOT.gROOT.SetBatch(True)
+    for filename, plot, kwargs in iter(queue.get, None):
+        try:
+            tfile = ROOT.TFile.Open(filename)
+            _plotters[plot](tfile.Get('ws'),tfile.Get('data'),**kwargs)
+            tfile.Close()
+        except Exception as e:
+            logging.error('Failed to draw {0}: {1}'.format(kwargs.get('savename',''),e))
+        finally:
+            os.remove(filename)
+
+def requestPlot(plot,ws,data,**kwargs):
+    '''Draw a plot of a fit now, queue it for the background process, or skip it, depending on the plot mode.'''
+    if _plotMode=='skip': return
+    if _plotMode=='async' and _plotQueue is not None:
+        # snapshot the fitted parameters, later fits may change the workspace
+        fd, filename = tempfile.mkstemp(prefix='fitplot_',suffix='.root')
+        os.close(fd)
+        tfile = ROOT.TFile(filename,'RECREATE')
+        tfile.WriteTObject(ws,'ws')
+        tfile.WriteTObject(data,'data')
+        tfile.Close()
+        _plotQueue.put((filename,plot.__name__,kwargs))
+        return
+    plot(ws,data,**kwargs)
+
+def plotFit(ws,data,pdf,x,saveDir,savename):
+    '''Draw the fitted pdf over the data.'''
+    if saveDir and not os.path.isdir(saveDir): os.makedirs(saveDir)
+    model = ws.pdf(pdf)
+    x = ws.var(x)
+    xFrame = x.frame()
+    xFrame.SetTitle('')
+    data.plotOn(xFrame)
+    model.plotOn(xFrame)
+    chi2Line = "Chi2: " + str(xFrame.chiSquare()) # Adding chi2 info
+    pt = ROOT.TPaveText(.72,.1,.90,.2, "brNDC") # Adding chi2 info
+    pt.AddText(chi2Line ) # Adding chi2 info
+    model.paramOn(xFrame,ROOT.RooFit.Layout(0.72,0.98,0.90))
+    canvas = ROOT.TCanvas(savename,savename,800,800)
+    canvas.SetRightMargin(0.3)
+    xFrame.Draw()
+    pt.Draw()
+    prims = canvas.GetListOfPrimitives()
+    for prim in prims:
+        if 'paramBox' in prim.GetName():
+            prim.SetTextSize(0.02)
+    canvas.Print('{0}.png'.format(savename))
+
+def plotFit2D(ws,data,pdf,x,y,saveDir,savename,logy=False):
+    '''Draw the x and y projections of the fitted pdf over the data and the pdf surface.'''
+    if saveDir and not os.path.isdir(saveDir): os.makedirs(saveDir)
+    model = ws.pdf(pdf)
+    x = ws.var(x)
+    xFrame = x.frame()
+    xFrame.SetTitle('')
+    data.plotOn(xFrame)
+    model.plotOn(xFrame)
+    chi2Linex = "Chi2: " +  str(xFrame.chiSquare()) # Adding chi2 info
+    ptx = ROOT.TPaveText(.72,.1,.90,.2, "brNDC") # Adding chi2 info
+    ptx.AddText(chi2Linex) # Adding chi2 info
+    model.paramOn(xFrame,ROOT.RooFit.Layout(0.72,0.98,0.90))
+    canvas = ROOT.TCanvas(savename,savename,800,800)
+    canvas.SetRightMargin(0.3)
+    xFrame.Draw()
+    ptx.Draw()
+    prims = canvas.GetListOfPrimitives()
+    for prim in prims:
+        if 'paramBox' in prim.GetName():
+            prim.SetTextSize(0.02)
+    canvas.Print('{0}_xproj.png'.format(savename))
+
+    y = ws.var(y)
+    yFrame = y.frame()
+    yFrame.SetTitle('')
+    data.plotOn(yFrame)
+    model.plotOn(yFrame)
+    chi2Liney = "Chi2: " + str(yFrame.chiSquare()) # Adding chi2 info
+    pty = ROOT.TPaveText(.72,.1,.90,.2, "brNDC") # Adding chi2 info            
+    pty.AddText(chi2Liney ) # Adding chi2 info
+    model.paramOn(yFrame,ROOT.RooFit.Layout(0.72,0.98,0.90))
+    if logy: canvas.SetLogy()
+    yFrame.Draw()
+    pty.Draw()
+    prims = canvas.GetListOfPrimitives()
+    for prim in prims:
+        if 'paramBox' in prim.GetName():
+            prim.SetTextSize(0.02)
+    canvas.Print('{0}_yproj.png'.format(savename))
+
+    histM = model.createHistogram('x,y',100,100)
+    histM.SetLineColor(ROOT.kBlue)
+    histM.Draw('surf')
+    canvas.Print('{0}_model.png'.format(savename))
+
+    if isinstance(data,ROOT.RooDataSet):
+        histD = data.createHistogram(x,y,20,20,'1','{}_hist'.format(savename))
+        histD.SetLineColor(ROOT.kBlack)
+        histD.Draw('surf')
+        canvas.Print('{0}_dataset.png'.format(savename))
+
+_plotters = {
+    'plotFit'   : plotFit,
+    'plotFit2D' : plotFit2D,
+}
+
 class Model(object):
 
     def __init__(self,name,**kwargs):
@@ -29,8 +275,86 @@ class Model(object):
         '''Dummy method to add model to workspace'''
         logging.debug('Building {}'.format(label))
 
-    def fit(self,ws,hist,name,save=False,doErrors=False,saveDir='', xFitRange=[0,30]):
-        '''Fit the model to a histogram and return the fit values'''
+    def setInitialValues(self,ws,initialValues):
+        '''
+        Set the starting values of workspace variables before a fit.
+        Values outside of a variable's range are moved to the nearest edge.
+        Returns the values that were set.
+        '''
+        result = {}
+        for param in sorted(initialValues or {}):
+            var = ws.var(param)
+            if not var:
+                logging.warning('Initial value for unknown parameter {0}'.format(param))
+                continue
+            val = min(max(initialValues[param],var.getMin()),var.getMax())
+            var.setVal(val)
+            result[param] = val
+        return result
+
+    def getFitKey(self,ws,hist,name,fitRanges,initialValues=None,fitOptions=None):
+        '''Key of a fit in the fit cache: the model configuration, the starting values, the fit options, the fit ranges, and the fitted data.'''
+        spec = [
+            self.__class__.__name__,
+            self.name,
+            json.dumps(self.kwargs,sort_keys=True,default=repr),
+            name,
+            repr(fitRanges),
+            json.dumps(initialValues or {},sort_keys=True),
+            json.dumps(fitOptions or {},sort_keys=True),
+        ]
+        for v in [self.x,self.y,self.z]:
+            if ws.var(v): spec += [v,repr((ws.var(v).getMin(),ws.var(v).getMax()))]
+        result = hashlib.sha1(' '.join(spec))
+        result.update(getDataHash(hist))
+        return result.hexdigest()
+
+    def __runFit(self,ws,model,hist,name,cache,fitRanges,initialValues=None,fitOptions=None):
+        '''
+        Fit and return a FitResult, starting from initialValues if given.
+        fitOptions control the likelihood evaluation, see getFitArgs.
+        With a cache directory, a stored result for the same model, starting values, fit options, ranges, and data
+        is used instead and the workspace parameters are set to its values.
+        '''
+        initialValues = self.setInitialValues(ws,initialValues)
+        key = self.getFitKey(ws,hist,name,fitRanges,initialValues,fitOptions) if cache else ''
+        result = readFitCache(cache,key) if cache else None
+        if result is not None:
+            logging.debug('Using cached fit {0} for {1}'.format(key,name))
+            for param in result:
+                var = ws.var(param)
+                if not var: continue
+                var.setVal(result[param])
+                var.setError(result.errors[param])
+            return result
+        fitArgs = getFitArgs(fitOptions)
+        # fitTo only takes up to 8 RooCmdArgs directly
+        cmdList = ROOT.RooLinkedList()
+        for arg in fitArgs: cmdList.Add(arg)
+        start = time.time()
+        fr = model.fitTo(hist,cmdList)#, ROOT.RooFit.Range('xRange'))
+        fitTime = time.time()-start
+        pars = fr.floatParsFinal()
+        vals = {}
+        errs = {}
+        for p in range(pars.getSize()):
+            vals[pars.at(p).GetName()] = pars.at(p).getValV()
+            errs[pars.at(p).GetName()] = pars.at(p).getError()
+        result = FitResult(vals,errs,fr.status(),covQual=fr.covQual(),edm=fr.edm(),minNll=fr.minNll(),time=fitTime,options=fitOptions or {})
+        logging.debug('Fit {0} {1}: status {2}, covQual {3}, {4:.2f} s'.format(self.__class__.__name__,name,result.status,result.covQual,result.time))
+        if cache: writeFitCache(cache,key,result)
+        return result
+
+    def fit(self,ws,hist,name,save=False,doErrors=False,saveDir='', xFitRange=[0,30], cache='', initialValues=None, fitOptions=None):
+        '''
+        Fit the model to a histogram and return the fit values.
+        initialValues is a dict of workspace variable name to starting value,
+        for example the result of a previous fit.
+        fitOptions configure the likelihood evaluation, for example
+        {'numCPU': 8, 'batch': True, 'offset': True}, see getFitArgs.
+        If cache is a directory, results are stored there and reused
+        when the model, fit range, and histogram contents are unchanged.
+        '''
 
         if isinstance(hist,ROOT.TH1):
             dhname = 'dh_{0}'.format(name)
@@ -39,42 +363,25 @@ class Model(object):
         model = ws.pdf(name)
        
         #ws.var('x').setRange('xRange', xFitRange[0], xFitRange[1])
-        fr = model.fitTo(hist,ROOT.RooFit.Save(),ROOT.RooFit.SumW2Error(True))#, ROOT.RooFit.Range('xRange'))
-        pars = fr.floatParsFinal()
-        vals = {}
-        errs = {}
-        for p in range(pars.getSize()):
-            vals[pars.at(p).GetName()] = pars.at(p).getValV()
-            errs[pars.at(p).GetName()] = pars.at(p).getError()
+        vals = self.__runFit(ws,model,hist,name,cache,[xFitRange],initialValues,fitOptions)
+        errs = vals.errors
 
         if save:
-            if saveDir: python_mkdir(saveDir)
             savename = '{}/{}_{}'.format(saveDir,self.name,name) if saveDir else '{}_{}'.format(self.name,name)
-            x = ws.var(self.x)
-            xFrame = x.frame()
-            xFrame.SetTitle('')
-            hist.plotOn(xFrame)
-            model.plotOn(xFrame)
-            chi2Line = "Chi2: " + str(xFrame.chiSquare()) # Adding chi2 info
-            pt = ROOT.TPaveText(.72,.1,.90,.2, "brNDC") # Adding chi2 info
-            pt.AddText(chi2Line ) # Adding chi2 info
-            model.paramOn(xFrame,ROOT.RooFit.Layout(0.72,0.98,0.90))
-            canvas = ROOT.TCanvas(savename,savename,800,800)
-            canvas.SetRightMargin(0.3)
-            xFrame.Draw()
-            pt.Draw()
-            prims = canvas.GetListOfPrimitives()
-            for prim in prims:
-                if 'paramBox' in prim.GetName():
-                    prim.SetTextSize(0.02)
-            canvas.Print('{0}.png'.format(savename))
+            requestPlot(plotFit,ws,hist,pdf=name,x=self.x,saveDir=saveDir,savename=savename)
 
         if doErrors:
             return vals, errs
         return vals
 
-    def fit2D(self,ws,hist,name,save=False,doErrors=False,saveDir='', xFitRange=[0,30], yFitRange=[0,30], logy=False):
-        '''Fit the model to a histogram and return the fit values'''
+    def fit2D(self,ws,hist,name,save=False,doErrors=False,saveDir='', xFitRange=[0,30], yFitRange=[0,30], logy=False, cache='', initialValues=None, fitOptions=None):
+        '''
+        Fit the model to a 2D histogram and return the fit values.
+        initialValues is a dict of workspace variable name to starting value.
+        fitOptions configure the likelihood evaluation, see getFitArgs.
+        If cache is a directory, results are stored there and reused
+        when the model, fit ranges, and histogram contents are unchanged.
+        '''
 
         if isinstance(hist,ROOT.TH1):
             dhname = 'dh_{0}'.format(name)
@@ -84,65 +391,12 @@ class Model(object):
         #ws.var('x').setRange('xRange', xFitRange[0], xFitRange[1])
         #ws.var('y').setRange('yRange', yFitRange[0], yFitRange[1])
         #print ("X_FIT_RANGE=", xFitRange, "\tY_FIT_RANGE=", yFitRange)
-        fr = model.fitTo(hist,ROOT.RooFit.Save(),ROOT.RooFit.SumW2Error(True))#, ROOT.RooFit.Range('yRange'), ROOT.RooFit.Range('xRange') )
-        pars = fr.floatParsFinal()
-        vals = {}
-        errs = {}
-        for p in range(pars.getSize()):
-            vals[pars.at(p).GetName()] = pars.at(p).getValV()
-            errs[pars.at(p).GetName()] = pars.at(p).getError()
+        vals = self.__runFit(ws,model,hist,name,cache,[xFitRange,yFitRange],initialValues,fitOptions)
+        errs = vals.errors
 
         if save:
-            if saveDir: python_mkdir(saveDir)
             savename = '{}/{}_{}'.format(saveDir,self.name,name) if saveDir else '{}_{}'.format(self.name,name)
-            x = ws.var(self.x)
-            xFrame = x.frame()
-            xFrame.SetTitle('')
-            hist.plotOn(xFrame)
-            model.plotOn(xFrame)
-            chi2Linex = "Chi2: " +  str(xFrame.chiSquare()) # Adding chi2 info
-            ptx = ROOT.TPaveText(.72,.1,.90,.2, "brNDC") # Adding chi2 info
-            ptx.AddText(chi2Linex) # Adding chi2 info
-            model.paramOn(xFrame,ROOT.RooFit.Layout(0.72,0.98,0.90))
-            canvas = ROOT.TCanvas(savename,savename,800,800)
-            canvas.SetRightMargin(0.3)
-            xFrame.Draw()
-            ptx.Draw()
-            prims = canvas.GetListOfPrimitives()
-            for prim in prims:
-                if 'paramBox' in prim.GetName():
-                    prim.SetTextSize(0.02)
-            canvas.Print('{0}_xproj.png'.format(savename))
-
-            y = ws.var(self.y)
-            yFrame = y.frame()
-            yFrame.SetTitle('')
-            hist.plotOn(yFrame)
-            model.plotOn(yFrame)
-            chi2Liney = "Chi2: " + str(yFrame.chiSquare()) # Adding chi2 info
-            pty = ROOT.TPaveText(.72,.1,.90,.2, "brNDC") # Adding chi2 info            
-            pty.AddText(chi2Liney ) # Adding chi2 info
-            model.paramOn(yFrame,ROOT.RooFit.Layout(0.72,0.98,0.90))
-            if logy: canvas.SetLogy()
-            yFrame.Draw()
-            pty.Draw()
-            prims = canvas.GetListOfPrimitives()
-            for prim in prims:
-                if 'paramBox' in prim.GetName():
-                    prim.SetTextSize(0.02)
-            canvas.Print('{0}_yproj.png'.format(savename))
-
-            histM = model.createHistogram('x,y',100,100)
-            histM.SetLineColor(ROOT.kBlue)
-            histM.Draw('surf')
-            canvas.Print('{0}_model.png'.format(savename))
-
-            if isinstance(hist,ROOT.RooDataSet):
-                histD = hist.createHistogram(x,y,20,20,'1','{}_hist'.format(savename))
-                histD.SetLineColor(ROOT.kBlack)
-                histD.Draw('surf')
-                canvas.Print('{0}_dataset.png'.format(savename))
-
+            requestPlot(plotFit2D,ws,hist,pdf=name,x=self.x,y=self.y,saveDir=saveDir,savename=savename,logy=logy)
 
         if doErrors:
             return vals, errs
@@ -0,0 +1,99 @@
+import time
+import json
+
+class _NullPhase(object):
+    '''Phase used when profiling is disabled, does nothing.'''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        return False
+
+_nullPhase = _NullPhase()
+
+class _Phase(object):
+    '''Times one call of a phase and adds it to the phase statistics.'''
+
+    def __init__(self,stats,objects):
+        self.stats = stats
+        self.objects = objects
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self,*args):
+        self.stats['time'] += time.time()-self.start
+        self.stats['calls'] += 1
+        self.stats['objects'] += self.objects
+        return False
+
+class Profiler(object):
+    '''
+    Profiler
+
+    Records the wall time, number of calls, and number of objects handled
+    for named phases, both in total and per datacard:
+
+        with profiler.phase('unwrap',objects=1):
+            ...
+
+    When disabled, phase returns a shared no-op context manager.
+    The results are available with asDict or written as JSON with dump.
+    '''
+
+    def __init__(self,enabled=False):
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        self.phases = {} # phases outside of any card
+        self.cards = {}  # card name -> phases
+        self.current = self.phases
+
+    def __getStats(self,name):
+        if name not in self.current: self.current[name] = {'calls': 0, 'time': 0., 'objects': 0}
+        return self.current[name]
+
+    def phase(self,name,objects=0):
+        '''Context manager timing a phase.'''
+        if not self.enabled: return _nullPhase
+        return _Phase(self.__getStats(name),objects)
+
+    def startCard(self):
+        '''Record the following phases for a single card.'''
+        self.current = {}
+
+    def endCard(self):
+        '''Stop recording for a single card and return its phases.'''
+        phases = self.current
+        self.current = self.phases
+        return phases
+
+    def __merge(self,phases,other):
+        for name,stats in other.iteritems():
+            if name not in phases: phases[name] = {'calls': 0, 'time': 0., 'objects': 0}
+            for key in stats:
+                phases[name][key] += stats[key]
+
+    def addCard(self,name,phases):
+        '''Add the phases of a card, for example returned by endCard in a worker process.'''
+        if name not in self.cards: self.cards[name] = {}
+        self.__merge(self.cards[name],phases)
+
+    def asDict(self):
+        '''Return {'phases': totals, 'cards': {card: phases}}.'''
+        totals = {}
+        self.__merge(totals,self.phases)
+        for name in self.cards:
+            self.__merge(totals,self.cards[name])
+        return {
+            'phases': totals,
+            'cards' : self.cards,
+        }
+
+    def dump(self,filename):
+        '''Write the results to a JSON file.'''
+        with open(filename,'w') as f:
+            json.dump(self.asDict(),f,indent=2,sort_keys=True)
@@ -5,12 +5,15 @@ import itertools
 import numpy as np
 import argparse
 import math
+import json
+import multiprocessing
 
 import ROOT
 ROOT.PyConfig.IgnoreCommandLineOptions = True
 ROOT.gROOT.SetBatch()
 
 from DevTools.Limits.Limits import Limits
+from DevTools.Limits.utilities import getHistBuffers, getHistEdges, buildHist
 from DevTools.Plotter.NtupleWrapper import NtupleWrapper
 from DevTools.Utilities.utilities import *
 from DevTools.Plotter.haaUtils import *
@@ -167,51 +170,103 @@ def sumHists(name,*hists):
     hist.Merge(histlist)
     return hist
 
-def getSpline(histMap,h,var=['mm'],tag=''):
+def getHistSpec(hist):
+    '''Bin arrays of a histogram that can be sent to a worker process, see buildHist.'''
+    contents, sumw2 = getHistBuffers(hist)
+    return (hist.ClassName(), hist.GetName(), hist.GetTitle(), getHistEdges(hist), contents, sumw2, hist.GetEntries())
+
+def fitMass(job):
+    '''Fit the signal shape at a single pseudoscalar mass and return the fitted values and errors.'''
+    h, a, tag, var, histSpec, initial, fitCache, fitOptions = job
+    ws = ROOT.RooWorkspace('sig')
+    binning = varBinning[var[0]]
+    ws.factory('x[{0}, {1}]'.format(*binning[1:]))
+    ws.var('x').setUnit('GeV')
+    ws.var('x').setPlotLabel('m_{#mu#mu}')
+    ws.var('x').SetTitle('m_{#mu#mu}')
+    model = Models.Voigtian('sig',
+        mean  = [a,0,30],
+        width = [0.01*a,0,5],
+        sigma = [0.01*a,0,5],
+    )
+    name = '{0}_{1}{2}'.format(h,a,tag)
+    model.build(ws, name)
+    hist = buildHist(*histSpec)
+    initialValues = dict([('{0}_{1}'.format(param,name),val) for param,val in initial.iteritems()]) if initial else None
+    vals, errs = model.fit(ws, hist, name, save=True, doErrors=True, cache=fitCache, initialValues=initialValues, fitOptions=fitOptions)
+    logging.info('Fit {0}: status {1}, covQual {2}, {3:.2f} s{4}'.format(name,vals.status,vals.covQual,vals.time,' (cached)' if vals.cached else ''))
+    return dict(vals), dict(errs)
+
+def fitTrend(job):
+    '''Fit the mass dependence of a signal shape parameter.'''
+    param, h, tag, vals, errs, fitCache, fitOptions = job
+    ws = ROOT.RooWorkspace(param)
+    ws.factory('x[{},{}]'.format(1,30))
+    ws.var('x').setUnit('GeV')
+    ws.var('x').setPlotLabel('m_{#mu#mu}')
+    ws.var('x').SetTitle('m_{#mu#mu}')
+    model = Models.Chebychev(param, order = 1, p0 = [0,-1,1], p1 = [0.1,-1,1], p2 = [0.03,-1,1])
+    name = '{}_{}{}'.format(param,h,tag)
+    model.build(ws, name)
+    hist = ROOT.TH1D(name, name, len(amasses), 4, 22)
+    for i,a in enumerate(amasses):
+        b = hist.FindBin(a)
+        hist.SetBinContent(b,vals[i])
+        hist.SetBinError(b,errs[i])
+    model.fit(ws, hist, name, save=True, cache=fitCache, fitOptions=fitOptions)
+
+def mapFits(func,jobs,workers=1):
+    '''Run fits serially or, with workers>1, in a pool of processes.'''
+    if workers<=1 or len(jobs)<=1:
+        return [func(job) for job in jobs]
+    pool = multiprocessing.Pool(min(workers,len(jobs)))
+    try:
+        return pool.map(func,jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+def getSeeds(spline):
+    '''Fitted mean, width, and sigma of a VoigtianSpline at each mass, used to start other fits.'''
+    seeds = {}
+    for a,mean,width,sigma in zip(*[spline.kwargs[k] for k in ['masses','means','widths','sigmas']]):
+        seeds[a] = {'mean': mean, 'width': width, 'sigma': sigma}
+    return seeds
+
+def getSpline(histMap,h,var=['mm'],tag='',fitCache='',workers=1,seed=None,fitOptions=None):
+    '''
+    Fit the signal at each pseudoscalar mass and return the interpolating spline.
+    With seed (for example the nominal spline when fitting a shifted template),
+    each mass starts from the seed's parameters. Otherwise, when fitting serially,
+    each mass starts from the previous mass' parameters scaled to the new mass.
+    '''
     # initial fit
     results = {}
     errors = {}
     results[h] = {}
     errors[h] = {}
-    for a in amasses:
-        ws = ROOT.RooWorkspace('sig')
-        binning = varBinning[var[0]]
-        ws.factory('x[{0}, {1}]'.format(*binning[1:]))
-        ws.var('x').setUnit('GeV')
-        ws.var('x').setPlotLabel('m_{#mu#mu}')
-        ws.var('x').SetTitle('m_{#mu#mu}')
-        model = Models.Voigtian('sig',
-            mean  = [a,0,30],
-            width = [0.01*a,0,5],
-            sigma = [0.01*a,0,5],
-        )
-        model.build(ws, 'sig')
-        hist = histMap[signame.format(h=h,a=a)]
-        results[h][a], errors[h][a] = model.fit(ws, hist, '{0}_{1}{2}'.format(h,a,tag), save=True, doErrors=True)
-
-    models = {
-        'mean' : Models.Chebychev('mean',  order = 1, p0 = [0,-1,1], p1 = [0.1,-1,1], p2 = [0.03,-1,1]),
-        'width': Models.Chebychev('width', order = 1, p0 = [0,-1,1], p1 = [0.1,-1,1], p2 = [0.03,-1,1]),
-        'sigma': Models.Chebychev('sigma', order = 1, p0 = [0,-1,1], p1 = [0.1,-1,1], p2 = [0.03,-1,1]),
-    }
-
-    for param in ['mean', 'width', 'sigma']:
-        ws = ROOT.RooWorkspace(param)
-        ws.factory('x[{},{}]'.format(1,30))
-        ws.var('x').setUnit('GeV')
-        ws.var('x').setPlotLabel('m_{#mu#mu}')
-        ws.var('x').SetTitle('m_{#mu#mu}')
-        model = models[param]
-        model.build(ws, param)
-        name = '{}_{}{}'.format(param,h,tag)
-        hist = ROOT.TH1D(name, name, len(amasses), 4, 22)
+    params = ['mean', 'width', 'sigma']
+    seeds = getSeeds(seed) if seed else {}
+    if seeds or workers>1:
+        jobs = [(h,a,tag,var,getHistSpec(histMap[signame.format(h=h,a=a)]),seeds.get(a),fitCache,fitOptions) for a in amasses]
+        fitted = mapFits(fitMass,jobs,workers)
+    else:
+        fitted = []
+        for a in amasses:
+            initial = None
+            if fitted:
+                pa = amasses[len(fitted)-1]
+                initial = dict([(param,fitted[-1][0]['{0}_{1}_{2}{3}'.format(param,h,pa,tag)]*float(a)/pa) for param in params])
+            fitted += [fitMass((h,a,tag,var,getHistSpec(histMap[signame.format(h=h,a=a)]),initial,fitCache,fitOptions))]
+    for a,(vals,errs) in zip(amasses,fitted):
+        results[h][a], errors[h][a] = vals, errs
+
+    jobs = []
+    for param in params:
         vals = [results[h][a]['{}_{}_{}{}'.format(param,h,a,tag)] for a in amasses]
         errs = [errors[h][a]['{}_{}_{}{}'.format(param,h,a,tag)] for a in amasses]
-        for i,a in enumerate(amasses):
-            b = hist.FindBin(a)
-            hist.SetBinContent(b,vals[i])
-            hist.SetBinError(b,errs[i])
-        model.fit(ws, hist, name, save=True)
+        jobs += [(param,h,tag,vals,errs,fitCache,fitOptions)]
+    mapFits(fitTrend,jobs,workers)
 
     # create model
     for a in amasses:
@@ -418,7 +473,7 @@ def create_datacard(args):
     #####################
     ### Create Limits ###
     #####################
-    limits = Limits(wsname)
+    limits = Limits(wsname,profile=args.profile)
     
     limits.addEra('Run2016')
     limits.addAnalysis('HAA')
@@ -427,6 +482,7 @@ def create_datacard(args):
     analysis = 'HAA'
     reco = 'mmmt'
     
+    nominalSplines = {}
     for mode in ['PP','PF']:
         limits.addChannel(mode)
         if doParametric:
@@ -440,7 +496,8 @@ def create_datacard(args):
             
             # add models
             for h in hmasses:
-                model = getSpline(histMap[mode][''],h,tag=mode)
+                model = getSpline(histMap[mode][''],h,tag=mode,fitCache=args.fitCache,workers=args.fitWorkers,fitOptions=args.fitOptions)
+                nominalSplines[(mode,h)] = model
                 limits.setExpected(splinename.format(h=h),era,analysis,mode,model)
 
             if doUnbinned:
@@ -497,16 +554,23 @@ def create_datacard(args):
         return newhist
     
     logging.info('Adding stat systematic')
+    # with autoMCStats the binned templates need no stat clones
+    # parametric cards store their templates in the workspace where autoMCStats does not apply, they keep the stat shapes
+    useAutoMCStats = args.autoMCStats is not None and not doParametric
+    if args.autoMCStats is not None and doParametric:
+        logging.warning('autoMCStats does not apply to parametric datacards, using stat shape systematics.')
+    statprocs = backgrounds+signals
+    if useAutoMCStats: statprocs = []
     statMapUp = {}
     statMapDown = {}
-    for proc in backgrounds+signals:
+    for proc in statprocs:
         statMapUp[proc] = getStat(histMap[mode][''][proc],'Up')
         statMapDown[proc] = getStat(histMap[mode][''][proc],'Down')
     statsyst = {}
 
     for mode in ['PP','PF']:
         # background
-        if doUnbinned:
+        if doUnbinned or useAutoMCStats:
             # TODO: add errors on params
             pass
         else:
@@ -516,12 +580,15 @@ def create_datacard(args):
         # signal
         if doParametric:
             for h in hmasses:
-                statsyst[((splinename.format(h=h),),(era,),(analysis,),(mode,))] = (getSpline(statMapUp,h,tag=mode+'StatUp'),getSpline(statMapDown,h,tag=mode+'StatDown'))
-        else:
+                statsyst[((splinename.format(h=h),),(era,),(analysis,),(mode,))] = (getSpline(statMapUp,h,tag=mode+'StatUp',fitCache=args.fitCache,workers=args.fitWorkers,fitOptions=args.fitOptions,seed=nominalSplines[(mode,h)]),getSpline(statMapDown,h,tag=mode+'StatDown',fitCache=args.fitCache,workers=args.fitWorkers,fitOptions=args.fitOptions,seed=nominalSplines[(mode,h)]))
+        elif not useAutoMCStats:
             for proc in sigproc:
                 statsyst[((proc,),(era,),(analysis,),(mode,))] = (statMapUp[proc],statMapDown[proc])
 
-    limits.addSystematic('stat_{process}_{channel}','shape',systematics=statsyst)
+    if statsyst:
+        limits.addSystematic('stat_{process}_{channel}','shape',systematics=statsyst)
+    if useAutoMCStats:
+        limits.addAutoMCStats(args.autoMCStats,includeSignal=True)
 
     ##############
     ### shifts ###
@@ -542,7 +609,7 @@ def create_datacard(args):
             # signal
             if doParametric:
                 for h in hmasses:
-                    shiftsyst[((splinename.format(h=h),),(era,),(analysis,),(mode,))] = (getSpline(histMap[mode][shift+'Up'],h,tag=mode+shift+'Up'),getSpline(histMap[mode][shift+'Down'],h,tag=mode+shift+'Down'))
+                    shiftsyst[((splinename.format(h=h),),(era,),(analysis,),(mode,))] = (getSpline(histMap[mode][shift+'Up'],h,tag=mode+shift+'Up',fitCache=args.fitCache,workers=args.fitWorkers,fitOptions=args.fitOptions,seed=nominalSplines[(mode,h)]),getSpline(histMap[mode][shift+'Down'],h,tag=mode+shift+'Down',fitCache=args.fitCache,workers=args.fitWorkers,fitOptions=args.fitOptions,seed=nominalSplines[(mode,h)]))
             else:
                 for proc in sigproc:
                     shiftsyst[((proc,),(era,),(analysis,),(mode,))] = (histMap[mode][shift+'Up'][proc], histMap[mode][shift+'Down'][proc])
@@ -602,7 +669,11 @@ def create_datacard(args):
     else:
         for signal in signals:
             processes[signal] = [signal]+backgrounds
-    limits.printCard(datacard,processes=processes,blind=False,saveWorkspace=doParametric)
+    if args.autoRebin:
+        limits.addAutoRebinning(*args.autoRebin)
+    limits.printCard(datacard,processes=processes,blind=False,saveWorkspace=doParametric,workers=args.workers,incremental=args.incremental,prune=args.prune,shapeToLnN=args.shapeToLnN)
+    if args.profile:
+        limits.profiler.dump('{0}.profile.json'.format(datacard))
 
 def parse_command_line(argv):
     parser = argparse.ArgumentParser(description='Create datacard')
@@ -615,6 +686,17 @@ def parse_command_line(argv):
     parser.add_argument('--higgs', type=int, default=125, choices=[125,300,750])
     parser.add_argument('--pseudoscalar', type=int, default=15, choices=[5,7,9,11,13,15,17,19,21])
     parser.add_argument('--tag', type=str, default='')
+    parser.add_argument('--incremental', action='store_true', help='Only rewrite datacards whose content changed')
+    parser.add_argument('--fitWorkers', type=int, default=1, help='Number of processes used for the signal fits')
+    parser.add_argument('--plotMode', type=str, default='inline', choices=Models.plotModes, help='Draw the fit plots inline, in a background process (async), or not at all (skip)')
+    parser.add_argument('--fitOptions', type=json.loads, default=None, help='Likelihood options for the signal fits as JSON, for example \'{"numCPU": 8, "batch": true, "offset": true}\'')
+    parser.add_argument('--fitCache', type=str, default='', help='Directory to store fit results, unchanged fits are not repeated')
+    parser.add_argument('--profile', action='store_true', help='Record the time spent in each phase of printing the datacards')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes used to print the datacards')
+    parser.add_argument('--prune', type=float, default=None, help='Drop nuisances with an effect below this threshold')
+    parser.add_argument('--autoMCStats', type=float, default=None, help='Use autoMCStats with this event threshold instead of stat shape systematics (binned datacards only)')
+    parser.add_argument('--autoRebin', type=float, nargs=2, default=None, metavar=('MINYIELD','MAXRELERROR'), help='Rebin templates so each bin has at least this background yield and at most this relative stat uncertainty')
+    parser.add_argument('--shapeToLnN', type=float, default=None, help='Write shape systematics with a normalised template chi2/ndf below this as lnN')
 
     return parser.parse_args(argv)
 
@@ -624,6 +706,8 @@ def main(argv=None):
 
     args = parse_command_line(argv)
 
+    Models.setPlotMode(args.plotMode)
+
     create_datacard(args)
 
 if __name__ == "__main__":
@@ -2,6 +2,11 @@ import math
 
 def addUncertainties(limits,staterr,uncerr,recoChans,signals,backgrounds,nl,doAlpha=True):
     '''Add common uncertainties for the H++ analysis'''
+    addStatUncertainties(limits,staterr,uncerr)
+    addCommonUncertainties(limits,recoChans,signals,backgrounds,nl,doAlpha=doAlpha)
+
+def addStatUncertainties(limits,staterr,uncerr):
+    '''Add the stat and shift uncertainties measured for one mass point'''
     # stat errs
     if staterr: limits.addSystematic('stat_{process}_{channel}','lnN',systematics=staterr)
 
@@ -10,6 +15,8 @@ def addUncertainties(limits,staterr,uncerr,recoChans,signals,backgrounds,nl,doAl
         for unc,errs in uncerr.iteritems():
             limits.addSystematic('{0}_unc'.format(unc),'lnN',systematics=errs)
 
+def addCommonUncertainties(limits,recoChans,signals,backgrounds,nl,doAlpha=True):
+    '''Add the fixed uncertainties for the H++ analysis, these do not depend on the mass point'''
     systproc = tuple([proc for proc in signals + backgrounds if 'datadriven' not in proc])
     sigproc = tuple([proc for proc in signals])
     approc = tuple([proc for proc in signals if 'HppHmm' not in proc])
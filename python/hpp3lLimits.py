@@ -1,6 +1,7 @@
 import os
 import sys
 import logging
+import argparse
 import ROOT
 import numpy as np
 import math
@@ -9,7 +10,7 @@ from DevTools.Limits.Limits import Limits
 from DevTools.Utilities.utilities import *
 from DevTools.Plotter.Counter import Counter
 from DevTools.Plotter.higgsUtilities import *
-from DevTools.Limits.higgsUncertainties import addUncertainties
+from DevTools.Limits.higgsUncertainties import addStatUncertainties, addCommonUncertainties
 
 logging.basicConfig(level=logging.INFO, stream=sys.stderr, format='%(asctime)s.%(msecs)03d %(levelname)s %(name)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
 
@@ -17,6 +18,13 @@ blind = False
 doShifts = True
 readUncerr = False # read from file rather than compute on the fly
 doPoisson = False
+incremental = True # only rewrite datacards whose content changed
+
+parser = argparse.ArgumentParser(description='Create the Hpp3l datacards')
+parser.add_argument('--prune', type=float, default=None, help='Drop nuisances that change no yield by more than this')
+args = parser.parse_args()
+
+prune = args.prune # None keeps all nuisances
 
 # define cards to create
 modes = ['ee100','em100','et100','mm100','mt100','tt100','BP1','BP2','BP3','BP4']
@@ -316,30 +324,39 @@ for s in signalsPPR:
 counters['data'] = Counter('Hpp3l')
 counters['data'].addProcess('data',sigMap['data'])
 for mode in modes:
+    # common skeleton for all masses of this mode
+    template = Limits()
+
+    template.addEra('Era13TeV2016')
+    template.addAnalysis('Hpp3l')
+    template.addAnalysis('Hpp3lAP')
+    template.addAnalysis('Hpp3lPP')
+    template.addAnalysis('Hpp3lPPR')
+
+    recoChans = getRecoChans(mode)
+    for reco in recoChans:
+        template.addChannel(reco)
+        template.addChannel(reco+'_SB')
+
+    for background in backgrounds:
+        template.addProcess(background)
+
+    # the signals of every mass are registered once so the fixed systematics can be added to the template,
+    # each card only includes the signals of its own mass
+    allSignals = ['HppHm{0}GeV'.format(mass) for mass in masses] + ['HppHmm{0}GeV'.format(mass) for mass in masses] + ['HppHmmR{0}GeV'.format(mass) for mass in masses]
+    for sig in allSignals:
+        template.addProcess(sig,signal=True)
+
+    addCommonUncertainties(template,recoChans,allSignals,backgrounds,3)
+
     for mass in masses:
         logging.info('Producing datacard for {0} - {1} GeV'.format(mode,mass))
         results = {}
-        limits = Limits()
-    
-        limits.addEra('Era13TeV2016')
-        limits.addAnalysis('Hpp3l')
-        limits.addAnalysis('Hpp3lAP')
-        limits.addAnalysis('Hpp3lPP')
-        limits.addAnalysis('Hpp3lPPR')
-        
-        recoChans = getRecoChans(mode)
-        for reco in recoChans:
-            limits.addChannel(reco)
-            limits.addChannel(reco+'_SB')
+        limits = template.clone()
 
         signalsAP = ['HppHm{0}GeV'.format(mass)]
         signalsPP = ['HppHmm{0}GeV'.format(mass)]
         signalsPPR = ['HppHmmR{0}GeV'.format(mass)]
-        for sig in signalsAP+signalsPP+signalsPPR:
-            limits.addProcess(sig,signal=True)
-        
-        for background in backgrounds:
-            limits.addProcess(background)
 
         # set values and stat error
         staterr = {}
@@ -363,14 +380,7 @@ for mode in modes:
                 valueSR,valueSB,side,alphaSR,errSR,alphaSB,errSB = getDualAlphaCount(counters,'{0}/{1}/{2}'.format(mass,hpphm,reco),datadriven=True)#reco.count('t')>=2 or reco[-1]=='t')
                 #if not valueSR or not valueSB:
                 #    print mode,mass,reco,valueSR,valueSB,side,alphaSR,errSR,alphaSB,errSB
-                limits.setExpected('datadriven',era,analysis,reco,valueSR)
-                limits.setExpected('datadriven',era,analysis+'AP',reco,valueSR)
-                limits.setExpected('datadriven',era,analysis+'PP',reco,valueSR)
-                limits.setExpected('datadriven',era,analysis+'PPR',reco,valueSR)
-                limits.setExpected('datadriven',era,analysis,recoSB,valueSB)
-                limits.setExpected('datadriven',era,analysis+'AP',recoSB,valueSB)
-                limits.setExpected('datadriven',era,analysis+'PP',recoSB,valueSB)
-                limits.setExpected('datadriven',era,analysis+'PPR',recoSB,valueSB)
+                limits.setExpectedSlice(['datadriven'],[era],[analysis,analysis+'AP',analysis+'PP',analysis+'PPR'],[reco,recoSB],[valueSR,valueSB])
                 limits.addSystematic('alpha_{era}_{analysis}_{channel}'.format(era=era,analysis=analysis,channel=reco),
                                      'gmN {0}'.format(int(side)),
                                      systematics={
@@ -427,10 +437,7 @@ for mode in modes:
             else:
                 for proc in backgrounds:
                     value,err = getCount(counters,proc,'new/allMassWindow/{0}/{1}/{2}'.format(mass,hpphm,reco))
-                    limits.setExpected(proc,era,analysis,reco,value)
-                    limits.setExpected(proc,era,analysis+'AP',reco,value)
-                    limits.setExpected(proc,era,analysis+'PP',reco,value)
-                    limits.setExpected(proc,era,analysis+'PPR',reco,value)
+                    limits.setExpectedSlice([proc],[era],[analysis,analysis+'AP',analysis+'PP',analysis+'PPR'],[reco],value)
                     if value: staterr[((proc,),(era,),(analysis,analysis+'AP',analysis+'PP',analysis+'PPR',),(reco,))] = 1+err/value
             # AP
             for proc in signalsAP:
@@ -449,8 +456,7 @@ for mode in modes:
                     value,err = getCount(counters,proc,'new/allSideband/{0}/{1}/{2}/gen_{3}'.format(mass,hpphm,reco,gen))
                     totalValueSB += scale*value
                     err2SB += (scale*err)**2
-                limits.setExpected(proc,era,analysis,reco,totalValue)
-                limits.setExpected(proc,era,analysis+'AP',reco,totalValue)
+                limits.setExpectedSlice([proc],[era],[analysis,analysis+'AP'],[reco],totalValue)
                 if totalValue: staterr[((proc,),(era,),(analysis,analysis+'AP',),(reco,))] = 1.+err2**0.5/totalValue
                 results[reco]['ap'] = totalValue
                 results[reco]['apError'] = err2**0.5
@@ -466,8 +472,7 @@ for mode in modes:
                             uncerr[unc][((proc,),(era,),(analysis,analysis+'AP',),(reco,))] = min([1+err/totalValue,2])
                             uncerr_store[unc]['{0}_{1}'.format(proc,reco)] = err/totalValue
                 # sideband components
-                limits.setExpected(proc,era,analysis,recoSB,totalValueSB)
-                limits.setExpected(proc,era,analysis+'AP',recoSB,totalValueSB)
+                limits.setExpectedSlice([proc],[era],[analysis,analysis+'AP'],[recoSB],totalValueSB)
                 if totalValueSB: staterr[((proc,),(era,),(analysis,analysis+'AP',),(recoSB,))] = 1.+err2SB**0.5/totalValueSB
                 results[recoSB]['ap'] = totalValueSB
                 results[recoSB]['apError'] = err2SB**0.5
@@ -499,8 +504,7 @@ for mode in modes:
                     value,err = getCount(counters,proc,'new/allSideband/{0}/{1}/{2}/gen_{3}'.format(mass,hpphm,reco,gen))
                     totalValueSB += scale*value
                     err2SB += (scale*err)**2
-                limits.setExpected(proc,era,analysis,reco,totalValue)
-                limits.setExpected(proc,era,analysis+'PP',reco,totalValue)
+                limits.setExpectedSlice([proc],[era],[analysis,analysis+'PP'],[reco],totalValue)
                 if totalValue: staterr[((proc,),(era,),(analysis,analysis+'PP',),(reco,))] = 1.+err2**0.5/totalValue
                 results[reco]['pp'] = totalValue
                 results[reco]['ppError'] = err2**0.5
@@ -516,8 +520,7 @@ for mode in modes:
                             uncerr[unc][((proc,),(era,),(analysis,analysis+'PP',),(reco,))] = min([1+err/totalValue,2])
                             uncerr_store[unc]['{0}_{1}'.format(proc,reco)] = err/totalValue
                 # sideband components
-                limits.setExpected(proc,era,analysis,recoSB,totalValueSB)
-                limits.setExpected(proc,era,analysis+'PP',recoSB,totalValueSB)
+                limits.setExpectedSlice([proc],[era],[analysis,analysis+'PP'],[recoSB],totalValueSB)
                 if totalValueSB: staterr[((proc,),(era,),(analysis,analysis+'PP',),(recoSB,))] = 1.+err2SB**0.5/totalValueSB
                 results[recoSB]['pp'] = totalValue
                 results[recoSB]['ppError'] = err2**0.5
@@ -582,17 +585,11 @@ for mode in modes:
                             uncerr_store[unc]['{0}_{1}'.format(proc,reco)] = err/totalValueSB
             # observed
             obs = getCount(counters,'data','new/allMassWindow/{0}/{1}/{2}'.format(mass,hpphm,reco))
-            limits.setObserved(era,analysis,reco,obs[0])
-            limits.setObserved(era,analysis+'AP',reco,obs[0])
-            limits.setObserved(era,analysis+'PP',reco,obs[0])
-            limits.setObserved(era,analysis+'PPR',reco,obs[0])
+            limits.setObservedSlice([era],[analysis,analysis+'AP',analysis+'PP',analysis+'PPR'],[reco],obs[0])
             results[reco]['observed'] = obs[0]
             # sideband
             obs = getCount(counters,'data','new/allSideband/{0}/{1}/{2}'.format(mass,hpphm,reco))
-            limits.setObserved(era,analysis,recoSB,obs[0])
-            limits.setObserved(era,analysis+'AP',recoSB,obs[0])
-            limits.setObserved(era,analysis+'PP',recoSB,obs[0])
-            limits.setObserved(era,analysis+'PPR',recoSB,obs[0])
+            limits.setObservedSlice([era],[analysis,analysis+'AP',analysis+'PP',analysis+'PPR'],[recoSB],obs[0])
             results[recoSB]['observed'] = obs[0]
             dumpResults(results,'Hpp3l','{0}/{1}'.format(mode,mass))
 
@@ -600,12 +597,12 @@ for mode in modes:
         if not readUncerr: dumpResults(uncerr_store,analysis,'shiftUncertainties_{0}_{1}'.format(mode,mass))
 
         # systematics
-        addUncertainties(limits,staterr,uncerr,recoChans,signalsAP+signalsPP+signalsPPR,backgrounds,3)
+        addStatUncertainties(limits,staterr,uncerr)
 
         # print the datacard
         directory = '{}/{}/{}'.format(outdirBase,'Hpp3l',mode)
         python_mkdir(directory)
-        limits.printCard('{0}/{1}'.format(directory,mass),analyses=['Hpp3l'],processes=signalsAP+signalsPP+backgrounds,blind=blind)
-        limits.printCard('{0}/{1}AP'.format(directory,mass),analyses=['Hpp3lAP'],processes=signalsAP+backgrounds,blind=blind)
-        limits.printCard('{0}/{1}PP'.format(directory,mass),analyses=['Hpp3lPP'],processes=signalsPP+backgrounds,blind=blind)
-        limits.printCard('{0}/{1}PPR'.format(directory,mass),analyses=['Hpp3lPPR'],processes=signalsPPR+backgrounds,blind=blind)
+        limits.printCard('{0}/{1}'.format(directory,mass),analyses=['Hpp3l'],processes=signalsAP+signalsPP+backgrounds,blind=blind,incremental=incremental,prune=prune)
+        limits.printCard('{0}/{1}AP'.format(directory,mass),analyses=['Hpp3lAP'],processes=signalsAP+backgrounds,blind=blind,incremental=incremental,prune=prune)
+        limits.printCard('{0}/{1}PP'.format(directory,mass),analyses=['Hpp3lPP'],processes=signalsPP+backgrounds,blind=blind,incremental=incremental,prune=prune)
+        limits.printCard('{0}/{1}PPR'.format(directory,mass),analyses=['Hpp3lPPR'],processes=signalsPPR+backgrounds,blind=blind,incremental=incremental,prune=prune)
@@ -1,6 +1,7 @@
 import os
 import sys
 import logging
+import argparse
 import ROOT
 import numpy as np
 import math
@@ -9,7 +10,7 @@ from DevTools.Limits.Limits import Limits
 from DevTools.Utilities.utilities import *
 from DevTools.Plotter.Counter import Counter
 from DevTools.Plotter.higgsUtilities import *
-from DevTools.Limits.higgsUncertainties import addUncertainties
+from DevTools.Limits.higgsUncertainties import addStatUncertainties, addCommonUncertainties
 
 logging.basicConfig(level=logging.INFO, stream=sys.stderr, format='%(asctime)s.%(msecs)03d %(levelname)s %(name)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
 
@@ -17,6 +18,13 @@ blind = False
 doShifts = True
 readUncerr = False # read from file rather than compute on the fly
 doPoisson = False
+incremental = True # only rewrite datacards whose content changed
+
+parser = argparse.ArgumentParser(description='Create the Hpp4l datacards')
+parser.add_argument('--prune', type=float, default=None, help='Drop nuisances that change no yield by more than this')
+args = parser.parse_args()
+
+prune = args.prune # None keeps all nuisances
 
 # define cards to create
 modes = ['ee100','em100','et100','mm100','mt100','tt100','BP1','BP2','BP3','BP4']
@@ -280,26 +288,35 @@ for s in signalsR:
 counters['data'] = Counter('Hpp4l')
 counters['data'].addProcess('data',sigMap['data'])
 for mode in modes:
+    # common skeleton for all masses of this mode
+    template = Limits()
+
+    template.addEra('Era13TeV2016')
+    template.addAnalysis('Hpp4l')
+
+    recoChans = getRecoChans(mode)
+    for reco in recoChans:
+        template.addChannel(reco)
+        template.addChannel(reco+'_SB')
+
+    for background in backgrounds:
+        template.addProcess(background)
+
+    # the signals of every mass are registered once so the fixed systematics can be added to the template,
+    # each card only includes the signals of its own mass
+    allSignals = ['HppHmm{0}GeV'.format(mass) for mass in masses] + ['HppHmmR{0}GeV'.format(mass) for mass in masses]
+    for sig in allSignals:
+        template.addProcess(sig,signal=True)
+
+    addCommonUncertainties(template,recoChans,allSignals,backgrounds,4)
+
     for mass in masses:
         logging.info('Producing datacard for {0} - {1} GeV'.format(mode,mass))
         results = {}
-        limits = Limits()
-    
-        limits.addEra('Era13TeV2016')
-        limits.addAnalysis('Hpp4l')
-        
-        recoChans = getRecoChans(mode)
-        for reco in recoChans:
-            limits.addChannel(reco)
-            limits.addChannel(reco+'_SB')
+        limits = template.clone()
 
         signals = ['HppHmm{0}GeV'.format(mass)]
         signalsR = ['HppHmmR{0}GeV'.format(mass)]
-        for sig in signals+signalsR:
-            limits.addProcess(sig,signal=True)
-        
-        for background in backgrounds:
-            limits.addProcess(background)
 
         # set values and stat error
         staterr = {}
@@ -323,8 +340,7 @@ for mode in modes:
                 valueSR,valueSB,side,alphaSR,errSR,alphaSB,errSB = getDualAlphaCount(counters,'{0}/{1}/{2}'.format(mass,hpphmm,reco),datadriven=True)#reco.count('t')>2 or reco[-2:]=='tt' or reco[:2]=='tt')
                 #if not valueSR or not valueSB:
                 #    print mode,mass,reco,valueSR,valueSB,side,alphaSR,errSR,alphaSB,errSB
-                limits.setExpected('datadriven',era,analysis,reco,valueSR)
-                limits.setExpected('datadriven',era,analysis,recoSB,valueSB)
+                limits.setExpectedSlice(['datadriven'],[era],[analysis],[reco,recoSB],[valueSR,valueSB])
                 limits.addSystematic('alpha_{era}_{analysis}_{channel}'.format(era=era,analysis=analysis,channel=reco),
                                      'gmN {0}'.format(int(side)),
                                      systematics={
@@ -491,10 +507,10 @@ for mode in modes:
         if not readUncerr: dumpResults(uncerr_store,analysis,'shiftUncertainties_{0}_{1}'.format(mode,mass))
 
         # systematics
-        addUncertainties(limits,staterr,uncerr,recoChans,signals+signalsR,backgrounds,4)
+        addStatUncertainties(limits,staterr,uncerr)
 
         # print the datacard
         directory = '{}/{}/{}'.format(outdirBase,'Hpp4l',mode)
         python_mkdir(directory)
-        limits.printCard('{0}/{1}'.format(directory,mass),processes=signals+backgrounds,blind=blind)
-        limits.printCard('{0}/{1}R'.format(directory,mass),processes=signalsR+backgrounds,blind=blind)
+        limits.printCard('{0}/{1}'.format(directory,mass),processes=signals+backgrounds,blind=blind,incremental=incremental,prune=prune)
+        limits.printCard('{0}/{1}R'.format(directory,mass),processes=signalsR+backgrounds,blind=blind,incremental=incremental,prune=prune)
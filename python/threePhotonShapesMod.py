@@ -20,6 +20,9 @@ binned = True
 addSignal = True
 wsname = 'w'
 doParametric = False
+autoMCStats = None # event threshold for autoMCStats, None for per-process stat shapes (always used with doParametric)
+autoRebinning = None # (minYield, maxRelError) for the summed background in each template bin, None to keep the binning
+shapeToLnN = None # chi2/ndf below which shape systematics are written as lnN, None to keep all shapes
 binning = [10,0,500]
 #binning = [10,0,250000]
 
@@ -144,16 +147,20 @@ def getStat(hist,direction):
     return newhist
 
 logging.info('Adding stat systematic')
-statMapUp = {}
-statMapDown = {}
-for proc in systproc:
-    statMapUp[proc] = getStat(histMap[proc],'Up')
-    statMapDown[proc] = getStat(histMap[proc],'Down')
-
-statsyst = {}
-for proc in systproc:
-    statsyst[((proc,),(era,),(analysis,),(reco,))] = (statMapUp[proc],statMapDown[proc])
-limits.addSystematic('stat_{process}_{channel}','shape',systematics=statsyst)
+# autoMCStats does not apply to the workspace templates of parametric cards
+if autoMCStats is None or doParametric:
+    statMapUp = {}
+    statMapDown = {}
+    for proc in systproc:
+        statMapUp[proc] = getStat(histMap[proc],'Up')
+        statMapDown[proc] = getStat(histMap[proc],'Down')
+
+    statsyst = {}
+    for proc in systproc:
+        statsyst[((proc,),(era,),(analysis,),(reco,))] = (statMapUp[proc],statMapDown[proc])
+    limits.addSystematic('stat_{process}_{channel}','shape',systematics=statsyst)
+else:
+    limits.addAutoMCStats(autoMCStats,includeSignal=True)
 
 ############
 ### Lumi ###
@@ -187,5 +194,7 @@ directory = 'datacards_shape/{0}'.format('ThreePhoton')
 python_mkdir(directory)
 datacard = '{0}/ggg_mod.txt'.format(directory)
 processes = ['sig','bg'] if doParametric else signals+backgrounds
-limits.printCard(datacard,processes=processes,blind=False,saveWorkspace=doParametric)
+if autoRebinning:
+    limits.addAutoRebinning(*autoRebinning)
+limits.printCard(datacard,processes=processes,blind=False,saveWorkspace=doParametric,shapeToLnN=shapeToLnN)
 
@@ -1,8 +1,11 @@
 import logging
 import os
 import sys
+import hashlib
+from array import array
 
 import ROOT
+import numpy as np
 
 def readCount(fileNames,directories,doError=False):
     val = 0.
@@ -43,3 +46,83 @@ def getHistogramIntegralError(hist,binlow=1,binhigh=-1):
     integralerr = ROOT.Double(0)
     hist.IntegralAndError(binlow,binhigh,integralerr,"")
     return float(integralerr)
+
+# storage type of the bin contents for each histogram flavour
+histDtypes = [
+    ('TArrayD', np.float64),
+    ('TArrayF', np.float32),
+    ('TArrayI', np.int32),
+    ('TArrayS', np.int16),
+    ('TArrayC', np.int8),
+]
+
+def getBufferArray(buf,n,dtype):
+    '''Wrap a ROOT array buffer of length n as a NumPy array (without copying).'''
+    if hasattr(buf,'SetSize'):
+        buf.SetSize(n)
+    else:
+        buf.reshape((n,))
+    return np.frombuffer(buf,dtype=dtype,count=n)
+
+def getHistBuffers(hist):
+    '''
+    Return the bin contents and the sum of squared weights of a histogram as
+    float64 NumPy arrays, in global bin order including under/overflow.
+    Both are copied from the histogram buffers in one operation.
+    '''
+    ncells = hist.GetNcells()
+    dtype = [d for c,d in histDtypes if hist.InheritsFrom(c)][0]
+    contents = getBufferArray(hist.GetArray(),ncells,dtype).astype(np.float64)
+    if hist.GetSumw2N():
+        sumw2 = getBufferArray(hist.GetSumw2().GetArray(),ncells,np.float64).copy()
+    else:
+        sumw2 = np.abs(contents)
+    return contents, sumw2
+
+def getHistHash(hist):
+    '''Return a hash of the binning, bin contents, and bin errors of a histogram.'''
+    result = hashlib.sha1(hist.ClassName())
+    for axis in [hist.GetXaxis(),hist.GetYaxis(),hist.GetZaxis()]:
+        result.update(array('d',[axis.GetBinLowEdge(b) for b in range(1,axis.GetNbins()+2)]).tostring())
+    contents, sumw2 = getHistBuffers(hist)
+    result.update(contents.tostring())
+    result.update(sumw2.tostring())
+    return result.hexdigest()
+
+def getHistEdges(hist):
+    '''Return the bin edges of each axis of a histogram as float64 NumPy arrays.'''
+    axes = [hist.GetXaxis(),hist.GetYaxis(),hist.GetZaxis()][:hist.GetDimension()]
+    return [np.array([axis.GetBinLowEdge(b) for b in range(1,axis.GetNbins()+2)],dtype=np.float64) for axis in axes]
+
+def buildHist(cls,name,title,edges,contents,sumw2,entries=0):
+    '''
+    Create a histogram of class cls (e.g. 'TH1F', 'TH2D') from the bin edges of
+    each axis and the bin contents/sum of squared weights in global bin order,
+    as returned by getHistEdges and getHistBuffers.
+    '''
+    args = []
+    for axisEdges in edges:
+        args += [len(axisEdges)-1, np.asarray(axisEdges,dtype=np.float64)]
+    hist = getattr(ROOT,cls)(name,title,*args)
+    hist.SetDirectory(0)
+    dtype = [d for c,d in histDtypes if hist.InheritsFrom(c)][0]
+    hist.Sumw2()
+    hist.Set(len(contents),np.asarray(contents).astype(dtype))
+    hist.GetSumw2().Set(len(sumw2),np.asarray(sumw2,dtype=np.float64))
+    hist.SetEntries(entries)
+    return hist
+
+def getDataHash(data):
+    '''Return a hash of the coordinates, weights, and weight errors of the entries of a RooDataHist/RooDataSet.'''
+    values = []
+    for i in range(data.numEntries()):
+        args = data.get(i)
+        it = args.createIterator()
+        arg = it.Next()
+        while arg:
+            values += [arg.getVal()]
+            arg = it.Next()
+        values += [data.weight(), data.weightError(ROOT.RooAbsData.SumW2)]
+    result = hashlib.sha1(data.ClassName())
+    result.update(array('d',values).tostring())
+    return result.hexdigest()
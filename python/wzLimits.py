@@ -3,6 +3,7 @@ import sys
 import logging
 import ROOT
 import math
+import numpy as np
 
 from DevTools.Limits.Limits import Limits
 from DevTools.Plotter.Counter import Counter
@@ -55,12 +56,14 @@ for bg in ['datadriven','ZZ','TTV','VVV','ZG']:
     limits.addProcess(bg)
 
 staterr = {}
-for chan in chans:
-    for process in samples+['datadriven']:
-        val,err = counts[chan][process]
-        limits.setExpected(process,era,analysis,chan,val)
-        if val: staterr[((process,),(era,),(analysis,),(chan,))] = 1+err/val
-    limits.setObserved('13TeV80X','WZ',chan,counts[chan]['data'][0])
+processes = samples+['datadriven']
+vals = np.array([[counts[chan][process][0] for chan in chans] for process in processes])
+errs = np.array([[counts[chan][process][1] for chan in chans] for process in processes])
+limits.setExpectedSlice(processes,[era],[analysis],chans,vals[:,np.newaxis,np.newaxis,:])
+limits.setObservedSlice([era],[analysis],chans,[counts[chan]['data'][0] for chan in chans])
+for p,process in enumerate(processes):
+    for c,chan in enumerate(chans):
+        if vals[p,c]: staterr[((process,),(era,),(analysis,),(chan,))] = 1+errs[p,c]/vals[p,c]
 
 limits.addSystematic('stat_{process}_{channel}','lnN',systematics=staterr)
 
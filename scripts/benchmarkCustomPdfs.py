@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+'''
+Micro-benchmark of the custom RooFit pdfs in src.
+
+For each pdf a dataset is generated and the negative log likelihood is
+evaluated repeatedly, changing a parameter every time as a minimiser would.
+Each pdf is run once varying the mean (the cached shape coefficients stay
+valid) and once varying a shape parameter (they are recomputed every time).
+The rate is reported in pdf evaluations per second, with the scalar and
+(where available) batch evaluation.
+
+Store a run with --output and compare a later build against it with
+--reference, which fails if any rate dropped by more than --maxSlowdown.
+benchmarkCustomPdfs.reference.json holds the rates of the current pdfs
+and benchmarkCustomPdfs.parent.json those before the tail coefficients
+of DoubleCrystalBallMod were cached (ROOT 6.40, default options, best of
+seven runs). The rates depend on the machine, so regenerate the reference
+with --output before comparing on another one.
+'''
+
+import sys
+import time
+import json
+import logging
+import argparse
+
+import ROOT
+ROOT.gROOT.SetBatch(True)
+ROOT.RooMsgService.instance().setGlobalKillBelow(ROOT.RooFit.WARNING)
+
+logging.basicConfig(level=logging.INFO, stream=sys.stderr, format='%(asctime)s.%(msecs)03d %(levelname)s %(name)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+xRange = [0, 30]
+
+# name, parameters in constructor order with their ranges, extra constructor arguments, parameters varied between evaluations
+pdfs = [
+    ('DoubleCrystalBallMod',
+     [('mean',10,0,30), ('sig',1,0.1,5), ('a1',1.5,0.1,10), ('n1',3,0.5,20), ('a2',2,0.1,10), ('n2',5,0.5,20)],
+     [],
+     ['mean','a1']),
+    ('DoubleSidedGaussianMod',
+     [('mean',10,0,30), ('sig1',1,0.1,5), ('sig2',2,0.1,5)],
+     [20.], # yMax
+     ['mean','sig2']),
+    ('DoubleSidedVoigtianMod',
+     [('mean',10,0,30), ('sig1',0.1,0.01,5), ('sig2',0.2,0.01,5), ('wid1',0.1,0.01,5), ('wid2',0.05,0.01,5)],
+     [20.], # yMax
+     ['mean','sig2']),
+]
+
+def buildWorkspace(name,params,extra):
+    ws = ROOT.RooWorkspace('w')
+    ws.factory('x[{0},{1}]'.format(*xRange))
+    for param in params:
+        ws.factory('{0}[{1},{2},{3}]'.format(*param))
+    args = [ws.var('x')] + [ws.var(param[0]) for param in params] + extra
+    pdf = getattr(ROOT,name)(name, name, *args)
+    getattr(ws, 'import')(pdf)
+    return ws
+
+def getBackends():
+    '''Likelihood evaluation modes available in this ROOT version.'''
+    if hasattr(ROOT.RooFit,'EvalBackend'):
+        return {'scalar': ROOT.RooFit.EvalBackend('legacy'), 'batch': ROOT.RooFit.EvalBackend('cpu')}
+    if hasattr(ROOT.RooFit,'BatchMode'):
+        return {'scalar': ROOT.RooFit.BatchMode(False), 'batch': ROOT.RooFit.BatchMode(True)}
+    return {'scalar': ROOT.RooCmdArg()}
+
+def benchmark(name,params,extra,varied,nEvents,repeats):
+    ws = buildWorkspace(name,params,extra)
+    pdf = ws.pdf(name)
+    x = ws.var('x')
+    var = ws.var(varied)
+    nominal = var.getVal()
+    data = pdf.generate(ROOT.RooArgSet(x),nEvents)
+    rates = {}
+    for backend,arg in sorted(getBackends().items()):
+        nll = pdf.createNLL(data,arg)
+        nll.getVal()
+        start = time.time()
+        for i in range(repeats):
+            var.setVal(nominal*(1+1e-4*(i%2)))
+            nll.getVal()
+        elapsed = time.time()-start
+        var.setVal(nominal)
+        rates[backend] = nEvents*repeats/elapsed
+        logging.info('{0} varying {1} {2}: {3:.3g} evaluations/s'.format(name,varied,backend,rates[backend]))
+    return rates
+
+def compare(results,reference,maxSlowdown):
+    failures = 0
+    for name in sorted(results):
+        for varied in sorted(results[name]):
+            for backend,rate in sorted(results[name][varied].items()):
+                if backend not in reference.get(name,{}).get(varied,{}): continue
+                ratio = rate/reference[name][varied][backend]
+                ok = ratio>=1-maxSlowdown
+                if not ok: failures += 1
+                logging.log(logging.INFO if ok else logging.ERROR,
+                    '{0} varying {1} {2}: {3:.3g} evaluations/s, {4:.2f} times the reference'.format(name,varied,backend,rate,ratio))
+    return failures
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the evaluation rate of the custom pdfs')
+
+    parser.add_argument('--events', type=int, default=100000, help='Number of events in the dataset')
+    parser.add_argument('--repeats', type=int, default=50, help='Number of likelihood evaluations')
+    parser.add_argument('--output', type=str, default='', help='Write the rates to this JSON file')
+    parser.add_argument('--reference', type=str, default='', help='Compare to the rates in this JSON file')
+    parser.add_argument('--maxSlowdown', type=float, default=0.3, help='Maximum allowed fractional drop of a rate with respect to the reference')
+
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    args = parse_command_line(argv)
+
+    results = {}
+    for name,params,extra,varied in pdfs:
+        results[name] = {}
+        for param in varied:
+            results[name][param] = benchmark(name,params,extra,param,args.events,args.repeats)
+
+    if args.output:
+        with open(args.output,'w') as f:
+            json.dump(results,f,indent=2,sort_keys=True)
+
+    if args.reference:
+        with open(args.reference) as f:
+            reference = json.load(f)
+        failures = compare(results,reference,args.maxSlowdown)
+        if failures:
+            logging.error('{0} rates are slower than the reference'.format(failures))
+            return 1
+
+    return 0
+
+if __name__ == "__main__":
+    status = main()
+    sys.exit(status)
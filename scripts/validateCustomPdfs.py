@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+'''
+Validate the custom RooFit pdfs in src.
+
+The analytical integrals of DoubleCrystalBallMod and DoubleSidedGaussianMod
+are compared to RooFit's numerical integration over the full x range and
+over sub-ranges for a set of parameter points.
+Their generators are checked by generating events over the full x range
+and over each sub-range, and comparing the binned events to the integral
+of the pdf in each bin with a chi2 test.
+The batch evaluation of all three pdfs (ROOT 6.28 and later) is compared
+to the scalar evaluate for the same points, once with constant parameters
+and once with the mean depending on x, so that the batch gets a value per
+event for it.
+'''
+
+import sys
+import logging
+import argparse
+
+import numpy as np
+import ROOT
+ROOT.gROOT.SetBatch(True)
+# the numerical reference integrals must be more precise than the tolerance
+ROOT.RooAbsReal.defaultIntegratorConfig().setEpsAbs(1e-12)
+ROOT.RooAbsReal.defaultIntegratorConfig().setEpsRel(1e-12)
+
+logging.basicConfig(level=logging.INFO, stream=sys.stderr, format='%(asctime)s.%(msecs)03d %(levelname)s %(name)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+xRange = [0, 30]
+subRanges = {
+    'low'   : [2, 8.5],
+    'core'  : [9, 10.3],
+    'high'  : [11.5, 20],
+}
+
+# name, parameters in constructor order with their ranges, extra constructor arguments, parameter points, analytical integral and generator
+pdfs = [
+    ('DoubleCrystalBallMod',
+     [('mean',10,0,30), ('sig',1,0.1,5), ('a1',1.5,0.1,10), ('n1',3,0.5,20), ('a2',2,0.1,10), ('n2',5,0.5,20)],
+     [],
+     [
+        {'mean': 10,   'sig': 1.,  'a1': 1.5, 'n1': 3.,  'a2': 2.,  'n2': 5.},
+        {'mean': 10,   'sig': 0.5, 'a1': 0.8, 'n1': 1.,  'a2': 1.2, 'n2': 2.5},
+        {'mean': 12.5, 'sig': 2.,  'a1': 1.,  'n1': 1.,  'a2': 1.,  'n2': 1.},
+     ],
+     True),
+    ('DoubleSidedGaussianMod',
+     [('mean',10,0,30), ('sig1',1,0.1,5), ('sig2',2,0.1,5)],
+     [20.], # yMax
+     [
+        {'mean': 10, 'sig1': 1., 'sig2': 2.},
+        {'mean': 10, 'sig1': 2., 'sig2': 0.5},
+        {'mean': 25, 'sig1': 3., 'sig2': 1.},
+     ],
+     True),
+    ('DoubleSidedVoigtianMod',
+     [('mean',10,0,30), ('sig1',0.1,0.01,5), ('sig2',0.1,0.01,5), ('wid1',0.1,0.01,5), ('wid2',0.1,0.01,5)],
+     [20.], # yMax
+     [
+        {'mean': 10, 'sig1': 0.1, 'sig2': 0.2, 'wid1': 0.1,  'wid2': 0.05},
+        {'mean': 5,  'sig1': 0.5, 'sig2': 0.3, 'wid1': 0.02, 'wid2': 0.2},
+     ],
+     False),
+]
+
+nBatchPoints = 1000
+
+# bins of the generated events, bins expecting fewer events than minExpected are skipped
+nGenBins = 20
+minExpected = 5
+
+# parameter replaced by param+perEventSlope*(x-center) in the per-event batch check
+perEventParam = 'mean'
+perEventSlope = 0.1
+
+def buildWorkspace(name,params,extra,perEvent=None):
+    ws = ROOT.RooWorkspace('w')
+    ws.factory('x[{0},{1}]'.format(*xRange))
+    for rangeName,(low,high) in subRanges.items():
+        ws.var('x').setRange(rangeName,low,high)
+    args = [ws.var('x')]
+    for param in params:
+        ws.factory('{0}[{1},{2},{3}]'.format(*param))
+        if param[0]==perEvent:
+            ws.factory('expr::{0}_x("{0}+{1}*(x-{2})",{0},x)'.format(param[0],perEventSlope,0.5*(xRange[0]+xRange[1])))
+            args += [ws.function('{0}_x'.format(param[0]))]
+        else:
+            args += [ws.var(param[0])]
+    args += extra
+    pdf = getattr(ROOT,name)(name, name, *args)
+    getattr(ws, 'import')(pdf)
+    return ws
+
+def getIntegral(pdf,x,rangeName=None,numeric=False):
+    pdf.forceNumInt(numeric)
+    intSet = ROOT.RooArgSet(x)
+    integral = pdf.createIntegral(intSet,rangeName) if rangeName else pdf.createIntegral(intSet)
+    return integral.getVal()
+
+def validateIntegrals(name,params,extra,points,tolerance):
+    ws = buildWorkspace(name,params,extra)
+    pdf = ws.pdf(name)
+    x = ws.var('x')
+    failures = 0
+    for point in points:
+        for param,val in point.items():
+            ws.var(param).setVal(val)
+        for rangeName in [None]+sorted(subRanges):
+            analytic = getIntegral(pdf,x,rangeName)
+            numeric = getIntegral(pdf,x,rangeName,numeric=True)
+            diff = abs(analytic-numeric)/max(abs(numeric),1e-12)
+            ok = diff<tolerance
+            if not ok: failures += 1
+            logging.log(logging.INFO if ok else logging.ERROR,
+                '{0} {1} range {2}: analytic {3:.6g} numeric {4:.6g} relative difference {5:.2g}'.format(
+                name, point, rangeName or 'full', analytic, numeric, diff))
+    pdf.forceNumInt(False)
+    return failures
+
+def getBinnedEvents(pdf,x,nEvents,low,high):
+    '''Generate events in [low,high] and return the observed and expected counts per bin.'''
+    x.setRange(low,high)
+    data = pdf.generate(ROOT.RooArgSet(x),nEvents)
+    vals = np.array([data.get(i).getRealValue(x.GetName()) for i in range(data.numEntries())])
+    edges = np.linspace(low,high,nGenBins+1)
+    observed = np.histogram(vals,edges)[0]
+    normSet = ROOT.RooArgSet(x)
+    expected = np.zeros(nGenBins)
+    for i,(binLow,binHigh) in enumerate(zip(edges[:-1],edges[1:])):
+        x.setRange('genBin',binLow,binHigh)
+        integral = pdf.createIntegral(normSet,ROOT.RooFit.NormSet(normSet),ROOT.RooFit.Range('genBin'))
+        expected[i] = integral.getVal()*nEvents
+    outside = np.sum((vals<low) | (vals>high))
+    x.setRange(*xRange)
+    return observed, expected, outside
+
+def validateGeneration(name,params,extra,points,nEvents,maxChi2):
+    ws = buildWorkspace(name,params,extra)
+    pdf = ws.pdf(name)
+    x = ws.var('x')
+    failures = 0
+    for point in points:
+        for param,val in point.items():
+            ws.var(param).setVal(val)
+        for rangeName in [None]+sorted(subRanges):
+            low, high = subRanges[rangeName] if rangeName else xRange
+            observed, expected, outside = getBinnedEvents(pdf,x,nEvents,low,high)
+            used = expected>=minExpected
+            chi2 = np.sum((observed[used]-expected[used])**2/expected[used])/max(np.sum(used),1)
+            ok = chi2<maxChi2 and not outside
+            if not ok: failures += 1
+            logging.log(logging.INFO if ok else logging.ERROR,
+                '{0} {1} range {2}: generated events chi2/ndf {3:.2f} ({4} bins), {5} outside the range'.format(
+                name, point, rangeName or 'full', chi2, np.sum(used), outside))
+    return failures
+
+def getBatchValues(pdf,x,xvals):
+    '''Normalised pdf values at xvals from the batch evaluation, with the current parameter values.'''
+    normSet = ROOT.RooArgSet(x)
+    if hasattr(pdf,'getValues'):
+        # ROOT 6.28 and 6.30
+        data = ROOT.RooDataSet('data','data',normSet)
+        for val in xvals:
+            x.setVal(val)
+            data.add(normSet)
+        return np.array(pdf.getValues(data,normSet))
+    # the compiled graph is a copy, so it is rebuilt for every parameter point
+    normalized = ROOT.RooFit.Detail.compileForNormSet(pdf,normSet)
+    evaluator = ROOT.RooFit.Evaluator(normalized)
+    evaluator.setInput(x.GetName(),ROOT.std.span['const double'](xvals,len(xvals)),False)
+    result = evaluator.run()
+    return np.array([result[i] for i in range(result.size())])
+
+def validateBatch(name,params,extra,points,tolerance,perEvent=None):
+    if ROOT.gROOT.GetVersionInt()<62800:
+        logging.warning('{0}: no batch evaluation before ROOT 6.28, skipping'.format(name))
+        return 0
+    ws = buildWorkspace(name,params,extra,perEvent)
+    pdf = ws.pdf(name)
+    x = ws.var('x')
+    normSet = ROOT.RooArgSet(x)
+    xvals = np.linspace(xRange[0],xRange[1],nBatchPoints,endpoint=False)
+    failures = 0
+    for point in points:
+        for param,val in point.items():
+            ws.var(param).setVal(val)
+        batch = getBatchValues(pdf,x,xvals)
+        scalar = np.zeros(len(xvals))
+        for i,val in enumerate(xvals):
+            x.setVal(val)
+            scalar[i] = pdf.getVal(normSet)
+        diff = np.max(np.abs(batch-scalar)/np.maximum(np.abs(scalar),1e-300))
+        ok = diff<tolerance
+        if not ok: failures += 1
+        logging.log(logging.INFO if ok else logging.ERROR,
+            '{0} {1}{2}: batch and scalar evaluation maximum relative difference {3:.2g}'.format(
+            name, point, ' {0} per event'.format(perEvent) if perEvent else '', diff))
+    return failures
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(description='Validate the custom pdfs against numerical integration and scalar evaluation')
+
+    parser.add_argument('--tolerance', type=float, default=1e-5, help='Maximum relative difference of the integrals')
+    parser.add_argument('--batchTolerance', type=float, default=1e-8, help='Maximum relative difference of the batch and scalar evaluation')
+    parser.add_argument('--events', type=int, default=20000, help='Number of events generated per parameter point and range')
+    parser.add_argument('--maxChi2', type=float, default=2., help='Maximum chi2/ndf of the generated events with respect to the pdf')
+    parser.add_argument('--seed', type=int, default=12345, help='Random seed for the generation')
+
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    args = parse_command_line(argv)
+
+    ROOT.RooRandom.randomGenerator().SetSeed(args.seed)
+
+    failures = 0
+    for name,params,extra,points,analytical in pdfs:
+        if analytical:
+            failures += validateIntegrals(name,params,extra,points,args.tolerance)
+            failures += validateGeneration(name,params,extra,points,args.events,args.maxChi2)
+        failures += validateBatch(name,params,extra,points,args.batchTolerance)
+        failures += validateBatch(name,params,extra,points,args.batchTolerance,perEvent=perEventParam)
+
+    if failures:
+        logging.error('{0} checks failed'.format(failures))
+        return 1
+    logging.info('All checks passed')
+    return 0
+
+if __name__ == "__main__":
+    status = main()
+    sys.exit(status)
@@ -10,10 +10,107 @@
 #include "RooAbsReal.h" 
 #include "RooAbsCategory.h" 
 #include <math.h> 
+#include <cassert>
 #include "TMath.h" 
+#include "RooRandom.h"
+#include "RooMsgService.h"
+#include <stdexcept>
 
 ClassImp(DoubleCrystalBallMod) 
 
+namespace {
+  // parameter dependent constants of the shape, evaluated per event with operator()
+  struct DCBShape {
+    double mean, sig, a1, n1, a2, n2, A1, A2, B1, B2;
+
+    DCBShape(double _mean, double _sig, double _a1, double _n1, double _a2, double _n2) :
+      mean(_mean), sig(_sig), a1(_a1), n1(_n1), a2(_a2), n2(_n2)
+    {
+      A1  = TMath::Power(n1/TMath::Abs(a1),n1)*TMath::Exp(-a1*a1/2);
+      A2  = TMath::Power(n2/TMath::Abs(a2),n2)*TMath::Exp(-a2*a2/2);
+      B1  = n1/TMath::Abs(a1) - TMath::Abs(a1);
+      B2  = n2/TMath::Abs(a2) - TMath::Abs(a2);
+    }
+
+    // with tail coefficients computed before
+    DCBShape(double _mean, double _sig, double _a1, double _n1, double _a2, double _n2,
+             double _A1, double _A2, double _B1, double _B2) :
+      mean(_mean), sig(_sig), a1(_a1), n1(_n1), a2(_a2), n2(_n2),
+      A1(_A1), A2(_A2), B1(_B1), B2(_B2)
+    {
+    }
+
+    double operator()(double x) const
+    {
+      double u = (x-mean)/sig;
+      if      (u<-a1) return A1*TMath::Power(B1-u,-n1);
+      else if (u<a2)  return TMath::Exp(-u*u/2);
+      else            return A2*TMath::Power(B2+u,-n2);
+    }
+  };
+
+  template <class Span>
+  inline double at(Span const& span, size_t i) { return span.size()==1 ? span[0] : span[i]; }
+
+  template <class Span>
+  void computeDCB(double* output, size_t n, Span x, Span mean, Span sig, Span a1, Span n1, Span a2, Span n2)
+  {
+    if (x.size()==n && mean.size()==1 && sig.size()==1 && a1.size()==1 && n1.size()==1 && a2.size()==1 && n2.size()==1) {
+      // constant parameters, the usual case in a fit
+      const DCBShape shape(mean[0],sig[0],a1[0],n1[0],a2[0],n2[0]);
+      for (size_t i=0; i<n; ++i) output[i] = shape(x[i]);
+      return;
+    }
+    for (size_t i=0; i<n; ++i)
+      output[i] = DCBShape(at(mean,i),at(sig,i),at(a1,i),at(n1,i),at(a2,i),at(n2,i))(at(x,i));
+  }
+
+  // integral of exp(-u^2/2) from u1 to u2
+  // erfc keeps the precision for an interval on one side of 0
+  double gaussCoreIntegral(double u1, double u2)
+  {
+    double scale = TMath::Sqrt(2.);
+    if (u1>=0) return TMath::Sqrt(TMath::Pi()/2) * (TMath::Erfc(u1/scale) - TMath::Erfc(u2/scale));
+    if (u2<=0) return TMath::Sqrt(TMath::Pi()/2) * (TMath::Erfc(-u2/scale) - TMath::Erfc(-u1/scale));
+    return TMath::Sqrt(TMath::Pi()/2) * (TMath::Erf(u2/scale) - TMath::Erf(u1/scale));
+  }
+
+  // integral of A*(B+u)^-n from u1 to u2, B+u > 0
+  double powerTailIntegral(double A, double B, double n, double u1, double u2)
+  {
+    if (TMath::Abs(n-1)<1e-5) return A * (TMath::Log(B+u2) - TMath::Log(B+u1));
+    return A / (1-n) * (TMath::Power(B+u2,1-n) - TMath::Power(B+u1,1-n));
+  }
+
+  // sample u in [u1,u2] from exp(-u^2/2)
+  // an interval on one side of 0 is inverted with erfc, which keeps the precision far in the tail
+  double sampleGaussCore(double u1, double u2)
+  {
+    double scale = TMath::Sqrt(2.);
+    double r = RooRandom::uniform();
+    if (u1>=0) {
+      double q1 = TMath::Erfc(u1/scale), q2 = TMath::Erfc(u2/scale);
+      return scale * TMath::ErfcInverse(q2 + r*(q1-q2));
+    }
+    if (u2<=0) {
+      double q1 = TMath::Erfc(-u2/scale), q2 = TMath::Erfc(-u1/scale);
+      return -scale * TMath::ErfcInverse(q2 + r*(q1-q2));
+    }
+    double p1 = TMath::Erf(u1/scale), p2 = TMath::Erf(u2/scale);
+    return scale * TMath::ErfInverse(p1 + r*(p2-p1));
+  }
+
+  // sample u in [u1,u2] from (B+u)^-n, B+u > 0
+  double samplePowerTail(double B, double n, double u1, double u2)
+  {
+    double r = RooRandom::uniform();
+    double w1 = B+u1, w2 = B+u2;
+    if (TMath::Abs(n-1)<1e-5) return w1*TMath::Power(w2/w1,r) - B;
+    double p1 = TMath::Power(w1,1-n), p2 = TMath::Power(w2,1-n);
+    return TMath::Power(p1 + r*(p2-p1),1/(1-n)) - B;
+  }
+}
+
  DoubleCrystalBallMod::DoubleCrystalBallMod(const char *name, const char *title, 
                         RooAbsReal& _x,
                         RooAbsReal& _mean,
@@ -29,7 +126,8 @@ ClassImp(DoubleCrystalBallMod)
    a1("a1","a1",this,_a1),
    n1("n1","n1",this,_n1),
    a2("a2","a2",this,_a2),
-   n2("n2","n2",this,_n2)
+   n2("n2","n2",this,_n2),
+   cacheValid(false)
  { 
  } 
 
@@ -42,26 +140,108 @@ ClassImp(DoubleCrystalBallMod)
    a1("a1",this,other.a1),
    n1("n1",this,other.n1),
    a2("a2",this,other.a2),
-   n2("n2",this,other.n2)
+   n2("n2",this,other.n2),
+   cacheValid(false)
  { 
  } 
 
 
 
+void DoubleCrystalBallMod::updateCache() const
+{
+  if (cacheValid && a1==cacheA1 && n1==cacheN1 && a2==cacheA2 && n2==cacheN2) return;
+  cacheA1 = a1; cacheN1 = n1; cacheA2 = a2; cacheN2 = n2;
+  DCBShape shape(0,1,a1,n1,a2,n2);
+  A1 = shape.A1; A2 = shape.A2;
+  B1 = shape.B1; B2 = shape.B2;
+  cacheValid = true;
+}
+
+
+
 Double_t DoubleCrystalBallMod::evaluate() const 
 { 
-	double u   = (x-mean)/sig;
-	double A1  = TMath::Power(n1/TMath::Abs(a1),n1)*TMath::Exp(-a1*a1/2);
-	double A2  = TMath::Power(n2/TMath::Abs(a2),n2)*TMath::Exp(-a2*a2/2);
-	double B1  = n1/TMath::Abs(a1) - TMath::Abs(a1);
-	double B2  = n2/TMath::Abs(a2) - TMath::Abs(a2);
-
-	double result(1);
-	if      (u<-a1) result *= A1*TMath::Power(B1-u,-n1);
-	else if (u<a2)  result *= TMath::Exp(-u*u/2);
-	else            result *= A2*TMath::Power(B2+u,-n2);
- 	return result;
+	updateCache();
+	return DCBShape(mean,sig,a1,n1,a2,n2,A1,A2,B1,B2)(x);
 } 
 
 
 
+#if ROOT_VERSION_CODE >= ROOT_VERSION(6,32,0)
+void DoubleCrystalBallMod::doEval(RooFit::EvalContext &ctx) const
+{
+  std::span<double> output = ctx.output();
+  computeDCB(output.data(), output.size(), ctx.at(x), ctx.at(mean), ctx.at(sig), ctx.at(a1), ctx.at(n1), ctx.at(a2), ctx.at(n2));
+}
+#elif ROOT_VERSION_CODE >= ROOT_VERSION(6,30,0)
+void DoubleCrystalBallMod::computeBatch(double* output, size_t nEvents, RooFit::Detail::DataMap const& dataMap) const
+{
+  computeDCB(output, nEvents, dataMap.at(x), dataMap.at(mean), dataMap.at(sig), dataMap.at(a1), dataMap.at(n1), dataMap.at(a2), dataMap.at(n2));
+}
+#elif ROOT_VERSION_CODE >= ROOT_VERSION(6,28,0)
+void DoubleCrystalBallMod::computeBatch(cudaStream_t*, double* output, size_t nEvents, RooFit::Detail::DataMap const& dataMap) const
+{
+  computeDCB(output, nEvents, dataMap.at(x), dataMap.at(mean), dataMap.at(sig), dataMap.at(a1), dataMap.at(n1), dataMap.at(a2), dataMap.at(n2));
+}
+#endif
+
+
+
+Int_t DoubleCrystalBallMod::getAnalyticalIntegral(RooArgSet& allVars, RooArgSet& analVars, const char* /*rangeName*/) const
+{
+  if (matchArgs(allVars,analVars,x)) return 1;
+  return 0;
+}
+
+
+
+Double_t DoubleCrystalBallMod::analyticalIntegral(Int_t code, const char* rangeName) const
+{
+  assert(code==1);
+  double umin = (x.min(rangeName)-mean)/sig;
+  double umax = (x.max(rangeName)-mean)/sig;
+  updateCache();
+
+  // same regions as evaluate, in units of sig
+  double result = 0;
+  if (umin<-a1) result += powerTailIntegral(A1,B1,n1,TMath::Max(-umax,a1),-umin);
+  if (umax>-a1 && umin<a2) result += gaussCoreIntegral(TMath::Max(umin,-a1),TMath::Min(umax,a2));
+  if (umax>a2) result += powerTailIntegral(A2,B2,n2,TMath::Max(umin,a2),umax);
+  return sig*result;
+}
+
+
+
+Int_t DoubleCrystalBallMod::getGenerator(const RooArgSet& directVars, RooArgSet &generateVars, Bool_t /*staticInitOK*/) const
+{
+  if (matchArgs(directVars,generateVars,x)) return 1;
+  return 0;
+}
+
+
+
+void DoubleCrystalBallMod::generateEvent(Int_t code)
+{
+  assert(code==1);
+  double umin = (x.min()-mean)/sig;
+  double umax = (x.max()-mean)/sig;
+  updateCache();
+
+  // probability of each region within the range, as in analyticalIntegral
+  double left = 0, core = 0, right = 0;
+  if (umin<-a1) left = powerTailIntegral(A1,B1,n1,TMath::Max(-umax,a1),-umin);
+  if (umax>-a1 && umin<a2) core = gaussCoreIntegral(TMath::Max(umin,-a1),TMath::Min(umax,a2));
+  if (umax>a2) right = powerTailIntegral(A2,B2,n2,TMath::Max(umin,a2),umax);
+  if (!(left+core+right>0)) {
+    coutE(Generation) << "DoubleCrystalBallMod::generateEvent(" << GetName() << ") the pdf is zero in the range of "
+                      << x.arg().GetName() << ", cannot generate" << std::endl;
+    throw std::runtime_error("DoubleCrystalBallMod::generateEvent: zero probability in the generation range");
+  }
+
+  double r = RooRandom::uniform()*(left+core+right);
+  double u;
+  if (r<left)            u = -samplePowerTail(B1,n1,TMath::Max(-umax,a1),-umin); // left tail mirrored
+  else if (r<left+core)  u = sampleGaussCore(TMath::Max(umin,-a1),TMath::Min(umax,a2));
+  else                   u = samplePowerTail(B2,n2,TMath::Max(umin,a2),umax);
+  x = mean + sig*u;
+}
@@ -10,11 +10,78 @@
 #include "RooAbsReal.h" 
 #include "RooAbsCategory.h" 
 #include <math.h> 
+#include <cassert>
 #include "TMath.h" 
 #include "RooGaussian.h"
+#include "RooRandom.h"
+#include "RooMsgService.h"
+#include <stdexcept>
 
 ClassImp(DoubleSidedGaussianMod) 
 
+namespace {
+  // parameter dependent constants of the shape, evaluated per event with operator()
+  struct DSGShape {
+    double sig1, sig2, mode, A1, A2, scaleFactor, total_integral;
+
+    DSGShape(double mean, double _sig1, double _sig2, double yMax) :
+      sig1(_sig1), sig2(_sig2)
+    {
+      double sqrt2pi = TMath::Power( 2 * TMath::Pi(), 0.5); 
+      mode = mean - 2 / sqrt2pi * (sig2 - sig1);
+      if (mode > yMax) 
+        mode = yMax;
+      A1 = 1 / (2*sig1*sqrt2pi);
+      A2 = 1 / (2*sig2*sqrt2pi);
+      scaleFactor = sig2 / sig1;
+      total_integral = 0.5 * (1 + scaleFactor);
+    }
+
+    double operator()(double x) const
+    {
+      if ( x < mode)
+        return A1 * TMath::Exp(-1 * (x-mode) * (x-mode) / (2 * sig1 * sig1)) / total_integral;
+      else
+        return A2 * TMath::Exp(-1 * (x-mode) * (x-mode) / (2 * sig2 * sig2)) * scaleFactor / total_integral;
+    }
+  };
+
+  template <class Span>
+  inline double at(Span const& span, size_t i) { return span.size()==1 ? span[0] : span[i]; }
+
+  template <class Span>
+  void computeDSG(double* output, size_t n, Span x, Span mean, Span sig1, Span sig2, double yMax)
+  {
+    if (x.size()==n && mean.size()==1 && sig1.size()==1 && sig2.size()==1) {
+      // constant parameters, the usual case in a fit
+      const DSGShape shape(mean[0],sig1[0],sig2[0],yMax);
+      for (size_t i=0; i<n; ++i) output[i] = shape(x[i]);
+      return;
+    }
+    for (size_t i=0; i<n; ++i)
+      output[i] = DSGShape(at(mean,i),at(sig1,i),at(sig2,i),yMax)(at(x,i));
+  }
+
+  // integral of exp(-(x-mu)^2/(2 sig^2)) from x1 to x2
+  // erfc keeps the precision for an interval on one side of mu
+  double halfGaussIntegral(double mu, double sig, double x1, double x2)
+  {
+    double scale = TMath::Sqrt(2.)*sig;
+    if (x1>=mu) return sig * TMath::Sqrt(TMath::Pi()/2) * (TMath::Erfc((x1-mu)/scale) - TMath::Erfc((x2-mu)/scale));
+    if (x2<=mu) return sig * TMath::Sqrt(TMath::Pi()/2) * (TMath::Erfc((mu-x2)/scale) - TMath::Erfc((mu-x1)/scale));
+    return sig * TMath::Sqrt(TMath::Pi()/2) * (TMath::Erf((x2-mu)/scale) - TMath::Erf((x1-mu)/scale));
+  }
+
+  // sample a distance d in [d1,d2], d1 >= 0, from exp(-d^2/(2 sig^2))
+  // erfc keeps the precision far in the tail
+  double sampleHalfGauss(double sig, double d1, double d2)
+  {
+    double scale = TMath::Sqrt(2.)*sig;
+    double q1 = TMath::Erfc(d1/scale), q2 = TMath::Erfc(d2/scale);
+    return scale * TMath::ErfcInverse(q2 + RooRandom::uniform()*(q1-q2));
+  }
+}
+
 DoubleSidedGaussianMod::DoubleSidedGaussianMod(const char *name, const char *title, 
                        RooAbsReal& _x,
                        RooAbsReal& _mean,
@@ -45,21 +112,82 @@ DoubleSidedGaussianMod::DoubleSidedGaussianMod(const DoubleSidedGaussianMod& oth
 
 Double_t DoubleSidedGaussianMod::evaluate() const 
 { 
-  double result = -1;
-  double sqrt2pi = TMath::Power( 2 * TMath::Pi(), 0.5); 
-  double mode = mean - 2 / sqrt2pi * (sig2 - sig1);
-  if (mode > yMax) 
-    mode = yMax;
-//  double A = 2 / sqrt2pi / (sig1 + sig2); 
-  double A1 = 1 / (2*sig1*sqrt2pi), A2 = 1 / (2*sig2*sqrt2pi);
-  double scaleFactor = sig2 / sig1;
-  double total_integral = 0.5 * (1 + scaleFactor);
-  if ( x < mode)
-    result = A1 * TMath::Exp(-1 * (x-mode) * (x-mode) / (2 * sig1 * sig1)) / total_integral;
-  else
-    result = A2 * TMath::Exp(-1 * (x-mode) * (x-mode) / (2 * sig2 * sig2)) * scaleFactor / total_integral;
-//  std::cout << "TESTY: x=" << x << "  result=" << result << " mean=" << mean << " mode=" << mode << "  scaleFactor=" << scaleFactor << "  total_integral=" << total_integral << " sig1=" << sig1 << "  sig2=" << sig2 << " A=" << A << " yMax=" << yMax <<std::endl;
-//  return A*result ;
-  return result;
+  return DSGShape(mean,sig1,sig2,yMax)(x);
 } 
 
+
+
+#if ROOT_VERSION_CODE >= ROOT_VERSION(6,32,0)
+void DoubleSidedGaussianMod::doEval(RooFit::EvalContext &ctx) const
+{
+  std::span<double> output = ctx.output();
+  computeDSG(output.data(), output.size(), ctx.at(x), ctx.at(mean), ctx.at(sig1), ctx.at(sig2), yMax);
+}
+#elif ROOT_VERSION_CODE >= ROOT_VERSION(6,30,0)
+void DoubleSidedGaussianMod::computeBatch(double* output, size_t nEvents, RooFit::Detail::DataMap const& dataMap) const
+{
+  computeDSG(output, nEvents, dataMap.at(x), dataMap.at(mean), dataMap.at(sig1), dataMap.at(sig2), yMax);
+}
+#elif ROOT_VERSION_CODE >= ROOT_VERSION(6,28,0)
+void DoubleSidedGaussianMod::computeBatch(cudaStream_t*, double* output, size_t nEvents, RooFit::Detail::DataMap const& dataMap) const
+{
+  computeDSG(output, nEvents, dataMap.at(x), dataMap.at(mean), dataMap.at(sig1), dataMap.at(sig2), yMax);
+}
+#endif
+
+
+
+Int_t DoubleSidedGaussianMod::getAnalyticalIntegral(RooArgSet& allVars, RooArgSet& analVars, const char* /*rangeName*/) const
+{
+  if (matchArgs(allVars,analVars,x)) return 1;
+  return 0;
+}
+
+
+
+Double_t DoubleSidedGaussianMod::analyticalIntegral(Int_t code, const char* rangeName) const
+{
+  assert(code==1);
+  double xmin = x.min(rangeName), xmax = x.max(rangeName);
+  const DSGShape shape(mean,sig1,sig2,yMax);
+  double mode = shape.mode;
+
+  // same sides as evaluate, split at the mode
+  double result = 0;
+  if (xmin < mode) result += shape.A1 * halfGaussIntegral(mode,sig1,xmin,TMath::Min(xmax,mode));
+  if (xmax > mode) result += shape.A2 * shape.scaleFactor * halfGaussIntegral(mode,sig2,TMath::Max(xmin,mode),xmax);
+  return result / shape.total_integral;
+}
+
+
+
+Int_t DoubleSidedGaussianMod::getGenerator(const RooArgSet& directVars, RooArgSet &generateVars, Bool_t /*staticInitOK*/) const
+{
+  if (matchArgs(directVars,generateVars,x)) return 1;
+  return 0;
+}
+
+
+
+void DoubleSidedGaussianMod::generateEvent(Int_t code)
+{
+  assert(code==1);
+  double xmin = x.min(), xmax = x.max();
+  DSGShape shape(mean,sig1,sig2,yMax);
+  double mode = shape.mode;
+
+  // probability of each side within the range
+  double left = 0, right = 0;
+  if (xmin < mode) left = shape.A1 * halfGaussIntegral(mode,sig1,xmin,TMath::Min(xmax,mode));
+  if (xmax > mode) right = shape.A2 * shape.scaleFactor * halfGaussIntegral(mode,sig2,TMath::Max(xmin,mode),xmax);
+  if (!(left+right>0)) {
+    coutE(Generation) << "DoubleSidedGaussianMod::generateEvent(" << GetName() << ") the pdf is zero in the range of "
+                      << x.arg().GetName() << ", cannot generate" << std::endl;
+    throw std::runtime_error("DoubleSidedGaussianMod::generateEvent: zero probability in the generation range");
+  }
+
+  if (RooRandom::uniform()*(left+right) < left)
+    x = mode - sampleHalfGauss(sig1,TMath::Max(mode-xmax,0.),mode-xmin);
+  else
+    x = mode + sampleHalfGauss(sig2,TMath::Max(xmin-mode,0.),xmax-mode);
+}
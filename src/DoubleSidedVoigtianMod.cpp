@@ -17,6 +17,53 @@
 
 ClassImp(DoubleSidedVoigtianMod) 
 
+DoubleSidedVoigtianMod::Shape::Shape(double sig1, double sig2, double wid1, double wid2)
+{
+  C1 = 1 / (TMath::Sqrt(2.0)*sig1);
+  C2 = 1 / (TMath::Sqrt(2.0)*sig2);
+  A1 = 0.5*C1*wid1;
+  A2 = 0.5*C2*wid2;
+  // match the two sides at the mean
+  std::complex<Double_t> Z1_at_mean(0,A1) ;
+  std::complex<Double_t> Z2_at_mean(0,A2) ;
+  std::complex<Double_t> voigt1_at_mean = RooMath::faddeeva_fast(Z1_at_mean);
+  std::complex<Double_t> voigt2_at_mean = RooMath::faddeeva_fast(Z2_at_mean);
+  scale_factor = (voigt1_at_mean.real() / voigt2_at_mean.real()) * (sig2/sig1);
+  total_integral = .5 * (1+scale_factor);
+  double sqrtpi = TMath::Sqrt(TMath::Pi());
+  norm1 = 0.5 * C1 / sqrtpi / total_integral;
+  norm2 = 0.5 * C2 / sqrtpi * scale_factor / total_integral;
+}
+
+double DoubleSidedVoigtianMod::Shape::operator()(double x, double mean) const
+{
+  if ( x < mean)
+    return norm1 * RooMath::faddeeva_fast(std::complex<Double_t>(C1*(x-mean),A1)).real();
+  else
+    return norm2 * RooMath::faddeeva_fast(std::complex<Double_t>(C2*(x-mean),A2)).real();
+}
+
+namespace {
+  typedef DoubleSidedVoigtianMod::Shape DSVShape;
+
+  template <class Span>
+  inline double at(Span const& span, size_t i) { return span.size()==1 ? span[0] : span[i]; }
+
+  template <class Span>
+  void computeDSV(double* output, size_t n, Span x, Span mean, Span sig1, Span sig2, Span wid1, Span wid2)
+  {
+    if (x.size()==n && mean.size()==1 && sig1.size()==1 && sig2.size()==1 && wid1.size()==1 && wid2.size()==1) {
+      // constant parameters, the usual case in a fit
+      const DSVShape shape(sig1[0],sig2[0],wid1[0],wid2[0]);
+      const double m = mean[0];
+      for (size_t i=0; i<n; ++i) output[i] = shape(x[i],m);
+      return;
+    }
+    for (size_t i=0; i<n; ++i)
+      output[i] = DSVShape(at(sig1,i),at(sig2,i),at(wid1,i),at(wid2,i))(at(x,i),at(mean,i));
+  }
+}
+
 DoubleSidedVoigtianMod::DoubleSidedVoigtianMod(const char *name, const char *title, 
                        RooAbsReal& _x,
                        RooAbsReal& _mean,
@@ -32,7 +79,8 @@ DoubleSidedVoigtianMod::DoubleSidedVoigtianMod(const char *name, const char *tit
   sig2("sig2","sig2",this,_sig2),
   wid1("wid1","wid1",this,_wid1),
   wid2("wid2","wid2",this,_wid2),
-  yMax(_yMax)
+  yMax(_yMax),
+  cacheValid(false)
 { 
 } 
 
@@ -45,48 +93,45 @@ DoubleSidedVoigtianMod::DoubleSidedVoigtianMod(const DoubleSidedVoigtianMod& oth
   sig2("sig2",this,other.sig2),
   wid1("wid1",this,other.wid1),
   wid2("wid2",this,other.wid2),
-  yMax(other.yMax)
+  yMax(other.yMax),
+  cacheValid(false)
 { 
 } 
 
 
 
+void DoubleSidedVoigtianMod::updateCache() const
+{
+  if (cacheValid && sig1==cacheSig1 && sig2==cacheSig2 && wid1==cacheWid1 && wid2==cacheWid2) return;
+  cacheSig1 = sig1; cacheSig2 = sig2; cacheWid1 = wid1; cacheWid2 = wid2;
+  cacheShape = Shape(sig1,sig2,wid1,wid2);
+  cacheValid = true;
+}
+
+
+
 Double_t DoubleSidedVoigtianMod::evaluate() const 
 { 
-  double sqrttwologtwo = TMath::Power( 2*TMath::Log(2), 0.5);
-  double gau1_width = sig1*sqrttwologtwo, gau2_width = sig2*sqrttwologtwo;
-  double voigt1_width = 0.5346*wid1 + TMath::Power(.2166*wid1*wid1+gau1_width*gau1_width, 0.5);
-  double voigt2_width = 0.5346*wid2 + TMath::Power(.2166*wid2*wid2+gau2_width*gau2_width, 0.5);
-  double mode = mean - TMath::Power(2/TMath::Pi(), 0.5) * (voigt2_width - voigt1_width);
-  if (mode > yMax)
-    mode = yMax;
-  double C1 = 1 / (TMath::Sqrt(2.0)*sig1); 
-  double C2 = 1 / (TMath::Sqrt(2.0)*sig2);
-  Double_t A1 = 0.5*C1*wid1;
-  Double_t A2 = 0.5*C2*wid2;
-  Double_t U1 = C1*(x-mean);
-  Double_t U2 = C2*(x-mean);
-  std::complex<Double_t> Z1(U1,A1) ;
-  std::complex<Double_t> Z2(U2,A2) ;
-  std::complex<Double_t> voigt(0.) ;
-  std::complex<Double_t> Z1_at_mean(0,A1) ;
-  std::complex<Double_t> Z2_at_mean(0,A2) ;
-  std::complex<Double_t> voigt1_at_mean = RooMath::faddeeva_fast(Z1);
-  std::complex<Double_t> voigt2_at_mean = RooMath::faddeeva_fast(Z2);
-  double scale_factor = (voigt1_at_mean.real() / voigt2_at_mean.real()) * (sig2/sig1);
-  double total_integral = .5 * (1+scale_factor);
-  if ( x < mean)
-  {
-    voigt = RooMath::faddeeva_fast(Z1);
-    return 0.5 * C1 * voigt.real() / TMath::Power(TMath::Pi(), 0.5) / total_integral;
-  }//if
-  else
-  {
-    voigt = RooMath::faddeeva_fast(Z2);
-    return 0.5 * C2 * voigt.real() / TMath::Power(TMath::Pi(), 0.5) * scale_factor / total_integral;
-  }//else
-
-} 
+  updateCache();
+  return cacheShape(x,mean);
+}
 
 
 
+#if ROOT_VERSION_CODE >= ROOT_VERSION(6,32,0)
+void DoubleSidedVoigtianMod::doEval(RooFit::EvalContext &ctx) const
+{
+  std::span<double> output = ctx.output();
+  computeDSV(output.data(), output.size(), ctx.at(x), ctx.at(mean), ctx.at(sig1), ctx.at(sig2), ctx.at(wid1), ctx.at(wid2));
+}
+#elif ROOT_VERSION_CODE >= ROOT_VERSION(6,30,0)
+void DoubleSidedVoigtianMod::computeBatch(double* output, size_t nEvents, RooFit::Detail::DataMap const& dataMap) const
+{
+  computeDSV(output, nEvents, dataMap.at(x), dataMap.at(mean), dataMap.at(sig1), dataMap.at(sig2), dataMap.at(wid1), dataMap.at(wid2));
+}
+#elif ROOT_VERSION_CODE >= ROOT_VERSION(6,28,0)
+void DoubleSidedVoigtianMod::computeBatch(cudaStream_t*, double* output, size_t nEvents, RooFit::Detail::DataMap const& dataMap) const
+{
+  computeDSV(output, nEvents, dataMap.at(x), dataMap.at(mean), dataMap.at(sig1), dataMap.at(sig2), dataMap.at(wid1), dataMap.at(wid2));
+}
+#endif